@@ -0,0 +1,41 @@
+#!/usr/bin/python
+# Compares the string fields with their packed variants: conversion speed and
+# bytes stored per value.
+#
+#   $ devtools/bench_packed_fields.py [repetitions]
+import os
+import sys
+import timeit
+from datetime import datetime
+
+# so the scripts run from a checkout, without installing tragedy or setting PYTHONPATH
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from tragedy.columns import (IntegerField, PackedIntegerField,
+                             FloatField, PackedFloatField,
+                             BooleanField, PackedBooleanField,
+                             TimeField, PackedTimeField,
+                            )
+
+cases = [
+    ('integer', IntegerField(), PackedIntegerField(), 1234567890123),
+    ('float', FloatField(), PackedFloatField(), 3.14159265358979),
+    ('boolean', BooleanField(), PackedBooleanField(), True),
+    ('time', TimeField(), PackedTimeField(), datetime(2010, 6, 26, 4, 18, 14, 123456)),
+]
+
+def bench(field, value, number):
+    stored = field.value_to_internal(value)
+    encode = timeit.timeit(lambda: field.value_to_internal(value), number=number)
+    decode = timeit.timeit(lambda: field.value_to_external(stored), number=number)
+    return encode, decode, len(stored)
+
+def run(number):
+    print '%-8s %-7s %12s %12s %6s' % ('field', 'form', 'encode us', 'decode us', 'bytes')
+    for name, string_field, packed_field, value in cases:
+        for form, field in (('string', string_field), ('packed', packed_field)):
+            encode, decode, size = bench(field, value, number)
+            print '%-8s %-7s %12.3f %12.3f %6d' % (name, form, encode / number * 1e6, decode / number * 1e6, size)
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,33 @@
+#!/usr/bin/python
+# Compares the JSONField serializers: encode and decode throughput and stored
+# bytes, for small, medium and large payloads.
+#
+#   $ devtools/bench_serializers.py [repetitions]
+import os
+import sys
+import timeit
+
+# so the scripts run from a checkout, without installing tragedy or setting PYTHONPATH
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from tragedy.columns import JSONField, serializers
+
+def payload(items):
+    return {'name': u'profile settings', 'version': 3, 'flags': [True, False, None],
+            'entries': [{'id': i, 'label': u'entry %d' % (i,), 'weight': i / 7.0} for i in xrange(items)]}
+
+payloads = [('small', payload(1)), ('medium', payload(50)), ('large', payload(2000))]
+
+def run(number):
+    print '%-7s %-8s %12s %12s %9s' % ('payload', 'codec', 'encode/s', 'decode/s', 'bytes')
+    for size, value in payloads:
+        count = max(number // len(value['entries']), 10)
+        for name in sorted(serializers):
+            field = JSONField(serializer=name)
+            stored = field.value_to_internal(value)
+            encode = timeit.timeit(lambda: field.value_to_internal(value), number=count)
+            decode = timeit.timeit(lambda: field.value_to_external(stored), number=count)
+            print '%-7s %-8s %12.0f %12.0f %9d' % (size, name, count / encode, count / decode, len(stored))
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,29 @@
+#!/usr/bin/python
+# Compares uuid.uuid1() with tragedy's TimeUUID generator, one at a time and in
+# bulk, and checks that the generated ids are unique and in order.
+#
+#   $ devtools/bench_timeuuid.py [count]
+import os
+import sys
+import timeit
+import uuid
+
+# so the scripts run from a checkout, without installing tragedy or setting PYTHONPATH
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from tragedy import timestamp
+
+def run(count):
+    candidates = [
+        ('uuid.uuid1().bytes', lambda: [uuid.uuid1().bytes for i in xrange(count)]),
+        ('newTimeUUID()', lambda: [timestamp.newTimeUUID() for i in xrange(count)]),
+        ('newTimeUUIDs(count)', lambda: timestamp.newTimeUUIDs(count)),
+    ]
+    print '%-20s %12s %10s %8s' % ('generator', 'ids/s', 'unique', 'ordered')
+    for name, generate in candidates:
+        seconds = timeit.timeit(generate, number=1)
+        times = [timestamp.uuidTime(u) for u in generate()]
+        print '%-20s %12.0f %10s %8s' % (name, count / seconds, len(set(times)) == count, times == sorted(times))
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,33 @@
+#!/usr/bin/python
+# Builds the reverse lookups for every unique Index of the models defined in a
+# module, e.g. for indexes that were written before reverse lookups existed.
+# Creates the missing reverse lookup column families first. Until it ran,
+# uniqueness checks scan the index rows.
+#
+#   $ devtools/build_reverse_lookups.py mymodels localhost:9160
+import os
+import sys
+
+# tragedy from this checkout and the models module from the current directory,
+# without installing either or setting PYTHONPATH
+sys.path[:0] = [os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir), os.getcwd()]
+
+from tragedy.hierarchy import cmcache
+
+def run(module_name, servers):
+    __import__(module_name)
+    for keyspace in cmcache.retrieve('keyspaces'):
+        if not keyspace._client:
+            keyspace.connect(servers=servers)
+        keyspace.verify_datamodel(auto_create_models=True, auto_drop_keyspace=False,
+                                  auto_drop_columnfamilies=False)
+        for model in keyspace.models.values():
+            if getattr(model, '_reverse_lookup', None):
+                print 'Building reverse lookup for %s...' % (model._column_family,)
+                print '%s entries.' % (model.build_reverse_lookups(),)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print 'usage: %s <models module> [server:port ...]' % (sys.argv[0],)
+        sys.exit(1)
+    run(sys.argv[1], sys.argv[2:] or None)
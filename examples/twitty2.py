@@ -36,8 +36,8 @@ class User(Model):
         a = self.tweets_sent()
         a.append( new_tweet ).save()
 
-        for follower in self.followed_by().load():
-            follower.receive(new_tweet)            
+        # one batch_mutate per 500 followers instead of one per follower
+        User.tweets_received.fanout(new_tweet, self.followed_by().iter_target_keys())
 
     def receive(self, tweet):
         self.tweets_received().append(tweet).save()
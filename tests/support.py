@@ -0,0 +1,155 @@
+"""Shared setup of the tests: one Keyspace for all test models, and an in-memory
+   stand-in for the Cassandra thrift client, so the tests run without a Cassandra node.
+
+   Run them from the repository root with: python -m unittest discover -s tests -t ."""
+import struct
+import threading
+import uuid
+
+from cassandra.ttypes import (Column, ColumnOrSuperColumn, KeySlice, SuperColumn)
+
+from tragedy import Cluster, Keyspace
+
+keyspace = Keyspace('TragedyTests', Cluster('Test Cluster'))
+
+def _timeuuid_key(column_key):
+    return (uuid.UUID(bytes=column_key).time, column_key)
+
+def _long_key(column_key):
+    return struct.unpack('>q', column_key)[0]
+
+sort_keys = {
+    'TimeUUIDType': _timeuuid_key,
+    'LongType': _long_key,
+}
+
+class FakeClient(object):
+    """Keeps column families as dicts of row key to dicts of column name to (value, ttl),
+       or to such dicts of sub-columns in Super column families. Clocks are ignored:
+       mutations are applied in the order they come in."""
+    thread_safe = True
+    _keyspace_set = 'TragedyTests'
+
+    def __init__(self, keyspace):
+        self.keyspace = keyspace
+        self.lock = threading.RLock()
+        self.data = {}
+        self.calls = []
+
+    def set_keyspace(self, name):
+        pass
+
+    def _model(self, column_family):
+        return self.keyspace.models[column_family]
+
+    def batch_mutate(self, mutation_map, consistency_level):
+        with self.lock:
+            self.calls.append(('batch_mutate', mutation_map))
+            for row_key, cfmap in mutation_map.iteritems():
+                for column_family, mutations in cfmap.iteritems():
+                    row = self.data.setdefault(column_family, {}).setdefault(row_key, {})
+                    for mutation in mutations:
+                        if mutation.column_or_supercolumn:
+                            self._insert(row, mutation.column_or_supercolumn)
+                        else:
+                            self._delete(row, mutation.deletion)
+
+    def _insert(self, row, column_or_supercolumn):
+        if column_or_supercolumn.column:
+            column = column_or_supercolumn.column
+            row[column.name] = (column.value, column.ttl)
+        else:
+            super_column = column_or_supercolumn.super_column
+            subcolumns = row.setdefault(super_column.name, {})
+            for column in super_column.columns:
+                subcolumns[column.name] = (column.value, column.ttl)
+
+    def _delete(self, row, deletion):
+        if deletion.super_column:
+            row = row.get(deletion.super_column, {})
+        if deletion.predicate is None:
+            row.clear()
+        else:
+            assert deletion.predicate.column_names is not None, 'Cassandra 0.7 only deletes columns by name.'
+            for column_key in deletion.predicate.column_names:
+                row.pop(column_key, None)
+
+    def _slice(self, column_parent, row_key, predicate):
+        model = self._model(column_parent.column_family)
+        row = self.data.get(column_parent.column_family, {}).get(row_key, {})
+        is_super = model._column_type == 'Super' and not column_parent.super_column
+        if column_parent.super_column:
+            row = row.get(column_parent.super_column, {})
+            sort_key = lambda column_key: column_key
+        else:
+            sort_key = sort_keys.get(model._order_by, lambda column_key: column_key)
+
+        if predicate.column_names is not None:
+            column_keys = [column_key for column_key in predicate.column_names if column_key in row]
+        else:
+            slice_range = predicate.slice_range
+            column_keys = sorted(row, key=sort_key, reverse=slice_range.reversed)
+            if slice_range.start:
+                start = sort_key(slice_range.start)
+                column_keys = [ck for ck in column_keys
+                                   if (sort_key(ck) <= start if slice_range.reversed else sort_key(ck) >= start)]
+            if slice_range.finish:
+                finish = sort_key(slice_range.finish)
+                column_keys = [ck for ck in column_keys
+                                   if (sort_key(ck) >= finish if slice_range.reversed else sort_key(ck) <= finish)]
+            column_keys = column_keys[:slice_range.count]
+
+        columns = []
+        for column_key in column_keys:
+            if is_super:
+                subcolumns = [Column(name=name, value=value, ttl=ttl) for name, (value, ttl) in sorted(row[column_key].items())]
+                columns.append(ColumnOrSuperColumn(super_column=SuperColumn(name=column_key, columns=subcolumns)))
+            else:
+                value, ttl = row[column_key]
+                columns.append(ColumnOrSuperColumn(column=Column(name=column_key, value=value, ttl=ttl)))
+        return columns
+
+    def get_slice(self, key, column_parent, predicate, consistency_level):
+        with self.lock:
+            self.calls.append(('get_slice', key))
+            return self._slice(column_parent, key, predicate)
+
+    def multiget_slice(self, keys, column_parent, predicate, consistency_level):
+        with self.lock:
+            self.calls.append(('multiget_slice', keys))
+            return dict((key, self._slice(column_parent, key, predicate)) for key in keys)
+
+    def get_count(self, key, column_parent, predicate, consistency_level):
+        with self.lock:
+            self.calls.append(('get_count', key))
+            return len(self._slice(column_parent, key, predicate))
+
+    def multiget_count(self, keyspace, keys, column_parent, predicate, consistency_level):
+        with self.lock:
+            self.calls.append(('multiget_count', keys))
+            return dict((key, len(self._slice(column_parent, key, predicate))) for key in keys)
+
+    def get_range_slices(self, column_parent, predicate, range, consistency_level):
+        """Key ranges only, in key order rather than token order."""
+        with self.lock:
+            self.calls.append(('get_range_slices', range.start_key))
+            row_keys = sorted(self.data.get(column_parent.column_family, {}))
+            row_keys = [row_key for row_key in row_keys if row_key >= range.start_key][:range.count]
+            return [KeySlice(key=row_key, columns=self._slice(column_parent, row_key, predicate))
+                        for row_key in row_keys]
+
+    def rows(self, column_family):
+        """The row keys of column_family that still have columns."""
+        with self.lock:
+            return sorted(row_key for row_key, row in self.data.get(column_family, {}).iteritems() if row)
+
+_initialized = set()
+
+def connect():
+    """Connects keyspace to a new, empty FakeClient and returns it."""
+    for model in keyspace.models.values():
+        if model not in _initialized: # activates generated indexes, only once per model
+            _initialized.add(model)
+            model._init_stage_two()
+    keyspace._client = FakeClient(keyspace)
+    return keyspace._client
@@ -0,0 +1,34 @@
+import unittest
+
+from tests import support
+from tragedy import Model, RowKey, AsciiField, IntegerField, JSONField
+
+class Sheet(Model):
+    _keyspace = support.keyspace
+    sheetid = RowKey(autogenerate=True)
+    title = AsciiField()
+
+    def __init__(self, *args, **kwargs):
+        self.rowcount = IntegerField(mandatory=False) # a field only this instance has
+        self.layout = JSONField(mandatory=False)
+        Model.__init__(self, *args, **kwargs)
+
+class InstanceFieldTest(unittest.TestCase):
+    def setUp(self):
+        self.client = support.connect()
+
+    def test_instance_fields_convert(self):
+        sheet = Sheet(title='budget', rowcount=12, layout={'columns': 3}).save()
+        stored = self.client.data['Sheet'][sheet.row_key]
+        self.assertEqual(stored['rowcount'][0], '12')
+        self.assertEqual(stored['layout'][0], '{"columns": 3}')
+
+        loaded = Sheet(sheet.row_key).load()
+        self.assertEqual(loaded.get('rowcount'), 12)
+        self.assertEqual(loaded.get('layout'), {'columns': 3})
+        self.assertEqual(dict(loaded)['rowcount'], 12)
+
+    def test_class_tables_stay_shared(self):
+        sheet = Sheet(title='budget')
+        self.assertTrue('rowcount' in sheet._field_specs)
+        self.assertFalse('rowcount' in Sheet._field_specs)
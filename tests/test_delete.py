@@ -0,0 +1,87 @@
+import unittest
+
+from tests import support
+from tragedy import Model, RowKey, AsciiField, AllIndex, SecondaryIndex
+from tragedy.models import TimeOrderedIndex
+from tragedy.columns import ForeignKey
+
+class DeleteItem(Model):
+    _keyspace = support.keyspace
+    itemid = RowKey(autogenerate=True)
+    color = AsciiField()
+    everything = AllIndex(shards=2, buckets='day')
+    by_color = SecondaryIndex(color)
+
+class DeleteItemBox(TimeOrderedIndex):
+    _keyspace = support.keyspace
+    _column_family = 'DeleteItemBox'
+    _buckets = 'day'
+    _shards = 2
+    boxid = RowKey()
+    targetmodel = ForeignKey(foreign_class=DeleteItem, unique=True)
+
+class DeleteTest(unittest.TestCase):
+    def setUp(self):
+        self.client = support.connect()
+        self.items = [DeleteItem('item%d' % (i,), color=('red', 'blue')[i % 2]).save() for i in xrange(6)]
+
+    def stored_targets(self, column_family):
+        return sorted(value for row_key in self.client.rows(column_family)
+                            for value, ttl in self.client.data[column_family][row_key].itervalues()
+                            if not row_key.startswith('!POPULATED!'))
+
+    def test_delete_many_removes_index_entries(self):
+        gone, kept = self.items[:3], self.items[3:]
+        self.assertEqual(DeleteItem.delete_many([item.row_key for item in gone]), 3)
+        self.assertEqual(self.client.rows('DeleteItem'), sorted(item.row_key for item in kept))
+
+        kept_keys = sorted(item.row_key for item in kept)
+        for index in (DeleteItem.everything, DeleteItem.by_color):
+            self.assertEqual(self.stored_targets(index._column_family), kept_keys)
+            self.assertEqual(sorted(column_key for row_key in self.client.rows(index._reverse_lookup._column_family)
+                                               if row_key != index._reverse_lookup._populated_row_key
+                                               for column_key in self.client.data[index._reverse_lookup._column_family][row_key]),
+                             kept_keys)
+        self.assertEqual(DeleteItem.everything.sweep(), 0)
+        self.assertEqual(DeleteItem.by_color.sweep(), 0)
+
+    def test_delete_row_matches_delete_many(self):
+        item = self.items[0]
+        item.delete_row()
+        self.assertFalse(item.row_key in self.stored_targets(DeleteItem.everything._column_family))
+        self.assertFalse(item.row_key in self.stored_targets(DeleteItem.by_color._column_family))
+
+    def test_row_deletion_forgets_buckets(self):
+        box = DeleteItemBox('box')
+        box.extend(self.items)
+        box.save()
+        DeleteItemBox('other').append(self.items[0]).save()
+        self.assertTrue(set(['box:0', 'box:1']) <= set(self.client.rows('DeleteItemBox_Buckets')))
+
+        del self.client.calls[:]
+        DeleteItemBox.delete_many(['box', 'other'])
+        self.assertEqual(self.client.rows('DeleteItemBox'), [])
+        self.assertEqual(self.client.rows('DeleteItemBox_Buckets'), [])
+        self.assertEqual(self.client.rows('DeleteItemBox_Reverse'), [])
+        reads = [call for call in self.client.calls if call[0] != 'batch_mutate']
+        self.assertEqual([call[0] for call in reads], ['multiget_slice'])
+        self.assertEqual(len([call for call in self.client.calls if call[0] == 'batch_mutate']), 1)
+
+    def test_trim_forgets_emptied_buckets(self):
+        box = DeleteItemBox('box')
+        box.extend(self.items)
+        box.save()
+        self.assertEqual(box.trim(keep_latest=0), len(self.items))
+        self.assertEqual(self.client.rows('DeleteItemBox'), [])
+        self.assertEqual(self.client.rows('DeleteItemBox_Buckets'), [])
+        self.assertEqual(DeleteItemBox('box').count(), 0)
+
+    def test_trim_keeps_buckets_in_use(self):
+        box = DeleteItemBox('box')
+        box.extend(self.items)
+        box.save()
+        self.assertEqual(box.trim(keep_latest=2), len(self.items) - 2)
+        newest = DeleteItemBox('box').load()
+        self.assertEqual(sorted(newest.values()), sorted(item.row_key for item in self.items[-2:]))
+        buckets = set(row_key.rsplit(':', 1)[0] for row_key in self.client.rows('DeleteItemBox'))
+        self.assertEqual(buckets, set(self.client.rows('DeleteItemBox_Buckets')))
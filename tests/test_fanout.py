@@ -0,0 +1,63 @@
+import threading
+import unittest
+
+from tests import support
+from tragedy import Model, Index, RowKey, AsciiField, ForeignKey
+from tragedy.exceptions import FanoutError
+
+class FanoutMember(Model):
+    _keyspace = support.keyspace
+    memberid = RowKey(autogenerate=True)
+    name = AsciiField()
+
+class FanoutInbox(Index):
+    _keyspace = support.keyspace
+    _default_field = ForeignKey(foreign_class=FanoutMember, unique=False)
+    inboxid = RowKey()
+
+class FanoutTest(unittest.TestCase):
+    def setUp(self):
+        self.client = support.connect()
+        self.member = FanoutMember(name='poster').save()
+        self.row_keys = ['inbox%02d' % (i,) for i in xrange(40)]
+
+    def fanout(self, **kwargs):
+        """Runs fanout in a thread, so a hanging fan-out fails the test instead of the run."""
+        outcome = []
+        def run():
+            try:
+                outcome.append(FanoutInbox.fanout(self.member, self.row_keys, batch_rows=5, **kwargs))
+            except Exception, e:
+                outcome.append(e)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive(), 'fanout hangs')
+        return outcome[0]
+
+    def test_fanout(self):
+        self.assertEqual(self.fanout(workers=4), len(self.row_keys))
+        self.assertEqual(self.client.rows('FanoutInbox'), self.row_keys)
+
+    def test_raising_progress_callback(self):
+        def progress(done):
+            raise ValueError('broken progress callback')
+        for workers in (1, 4):
+            error = self.fanout(workers=workers, progress=progress)
+            self.assertTrue(isinstance(error, FanoutError), repr(error))
+            self.assertTrue(isinstance(error.cause, ValueError))
+            self.assertTrue(error.done > 0)
+
+    def test_failing_write(self):
+        batch_mutate = self.client.batch_mutate
+        calls = []
+        def failing_batch_mutate(mutation_map, consistency_level):
+            calls.append(mutation_map)
+            if len(calls) == 3:
+                raise IOError('connection lost')
+            return batch_mutate(mutation_map, consistency_level)
+        self.client.batch_mutate = failing_batch_mutate
+        error = self.fanout(workers=4)
+        self.assertTrue(isinstance(error, FanoutError), repr(error))
+        self.assertTrue(isinstance(error.cause, IOError))
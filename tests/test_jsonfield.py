@@ -0,0 +1,34 @@
+import unittest
+
+from tests import support
+from tragedy import Model, RowKey, JSONField, CompressedField
+
+class JSONThing(Model):
+    _keyspace = support.keyspace
+    thingid = RowKey(autogenerate=True)
+    settings = JSONField()
+    history = CompressedField(JSONField(mandatory=False), threshold=16)
+
+class JSONFieldTest(unittest.TestCase):
+    def setUp(self):
+        self.client = support.connect()
+
+    def test_changes_in_place_are_saved(self):
+        thing = JSONThing(settings={'theme': 'dark'}, history=[1, 2]).save()
+        loaded = JSONThing(thing.row_key).load()
+        loaded.get('settings')['theme'] = 'light'
+        loaded.get('history').append(3)
+        loaded.save()
+
+        again = JSONThing(thing.row_key).load()
+        self.assertEqual(again.get('settings'), {'theme': 'light'})
+        self.assertEqual(again.get('history'), [1, 2, 3])
+
+    def test_unchanged_values_are_not_written(self):
+        thing = JSONThing(settings={'theme': 'dark'}).save()
+        loaded = JSONThing(thing.row_key).load()
+        loaded.get('settings')
+        loaded.save()
+        written = [mutation.column_or_supercolumn.column.name for call in self.client.calls if call[0] == 'batch_mutate'
+                                                              for mutation in call[1].get(thing.row_key, {}).get('JSONThing', [])]
+        self.assertEqual(written.count('settings'), 1) # by the first save only
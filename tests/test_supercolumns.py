@@ -0,0 +1,40 @@
+import unittest
+
+from tests import support
+from tragedy import Model, RowKey, UnicodeField, IntegerField
+from tragedy.columns import SuperField
+
+class SuperThing(Model):
+    _keyspace = support.keyspace
+    _column_type = 'Super'
+    thingid = RowKey(autogenerate=True)
+    name = UnicodeField()
+    size = IntegerField()
+    labels = SuperField(mandatory=False)
+    sizes = SuperField(subfield=IntegerField(), mandatory=False)
+
+class SuperColumnTest(unittest.TestCase):
+    def setUp(self):
+        self.client = support.connect()
+
+    def test_scalar_fields_round_trip(self):
+        thing = SuperThing(name=u'bear', size=3, labels={'color': 'red'}).save()
+        loaded = SuperThing(thing.row_key).load()
+        self.assertEqual(loaded.get('name'), u'bear')
+        self.assertEqual(loaded.get('size'), 3)
+        self.assertEqual(loaded.get('labels'), {'color': 'red'})
+        self.assertEqual(loaded.get('created_at'), thing.get('created_at'))
+        self.assertEqual(loaded.get('last_modified'), thing.get('last_modified'))
+
+    def test_set_subcolumn_converts(self):
+        thing = SuperThing(name=u'box', size=1).save()
+        thing.set_subcolumn('sizes', 'width', 12)
+        thing.set_subcolumn('labels', 'owner', u'j\xfcrgen')
+        thing.save()
+        stored = self.client.data['SuperThing'][thing.row_key]
+        self.assertEqual(stored['sizes']['width'][0], '12')
+        self.assertEqual(stored['labels']['owner'][0], u'j\xfcrgen'.encode('utf-8'))
+
+        loaded = SuperThing(thing.row_key).load()
+        self.assertEqual(loaded.get('sizes'), {'width': 12})
+        self.assertEqual(loaded.get('size'), 1)
@@ -0,0 +1,35 @@
+import unittest
+
+from tests import support
+from tragedy import Model, RowKey, AsciiField, AllIndex
+
+class SweepItem(Model):
+    _keyspace = support.keyspace
+    itemid = RowKey(autogenerate=True)
+    name = AsciiField()
+    everything = AllIndex(shards=4)
+
+class SweepTest(unittest.TestCase):
+    def setUp(self):
+        self.client = support.connect()
+        self.items = [SweepItem('item%d' % (i,), name='item%d' % (i,)).save() for i in xrange(12)]
+
+    def stored_targets(self, column_family):
+        return sorted(value for row_key in self.client.rows(column_family)
+                            for value, ttl in self.client.data[column_family][row_key].itervalues())
+
+    def test_sweep_sharded_index(self):
+        index = SweepItem.everything
+        self.assertEqual(len(self.client.rows(index._column_family)), 4)
+        
+        gone = self.items[:5]
+        for item in gone: # rows that vanished without their index entries
+            del self.client.data['SweepItem'][item.row_key]
+        
+        self.assertEqual(index.sweep(page_size=3), len(gone))
+        kept = sorted(item.row_key for item in self.items[5:])
+        self.assertEqual(self.stored_targets(index._column_family), kept)
+        self.assertEqual(sorted(column_key for row_key in self.client.rows(index._reverse_lookup._column_family)
+                                           for column_key in self.client.data[index._reverse_lookup._column_family][row_key]
+                                           if row_key != index._reverse_lookup._populated_row_key), kept)
+        self.assertEqual(index.sweep(page_size=3), 0)
@@ -0,0 +1,35 @@
+import os
+import unittest
+import uuid
+
+from tragedy import timestamp
+
+class TimeUUIDGeneratorTest(unittest.TestCase):
+    def test_forked_child_makes_other_uuids(self):
+        generator = timestamp.TimeUUIDGenerator(clock_seq=42)
+        generator.next() # a block of ticks the child must not reuse
+
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(read_end)
+                os.write(write_end, ''.join(generator.next_many(100)))
+            finally:
+                os._exit(0)
+        os.close(write_end)
+        child = ''
+        while True:
+            data = os.read(read_end, 4096)
+            if not data:
+                break
+            child += data
+        os.close(read_end)
+        os.waitpid(pid, 0)
+
+        child = [child[i:i + 16] for i in xrange(0, len(child), 16)]
+        parent = generator.next_many(100)
+        self.assertEqual(len(child), 100)
+        self.assertFalse(set(child) & set(parent))
+        self.assertNotEqual(uuid.UUID(bytes=child[0]).clock_seq, 42)
+        self.assertEqual(uuid.UUID(bytes=parent[0]).clock_seq, 42)
@@ -0,0 +1,77 @@
+import threading
+import unittest
+
+from tests import support
+from tragedy import Model, RowKey, AsciiField, IntegerField
+from tragedy.exceptions import TragedyException
+
+class Counter(Model):
+    _keyspace = support.keyspace
+    counterid = RowKey()
+    name = AsciiField(mandatory=False)
+    value = IntegerField(mandatory=False)
+
+class GatedClient(object):
+    """Lets batch_mutate through only once the gate is open, and fails the ones told to."""
+    thread_safe = True
+
+    def __init__(self, client):
+        self.client = client
+        self.gate = threading.Event()
+        self.fail = []
+
+    def batch_mutate(self, mutation_map, consistency_level):
+        self.gate.wait()
+        if self.fail:
+            raise self.fail.pop()
+        return self.client.batch_mutate(mutation_map, consistency_level)
+
+class WriteBehindTest(unittest.TestCase):
+    def setUp(self):
+        self.client = support.connect()
+        self.gated = GatedClient(self.client)
+        self.writer = support.keyspace.configure_write_behind(workers=1)
+        self.writer.getclient = lambda: self.gated
+
+    def tearDown(self):
+        self.gated.gate.set()
+        support.keyspace.configure_write_behind().close()
+
+    def written_values(self, row_key):
+        return [mutation.column_or_supercolumn.column.value
+                    for call in self.client.calls if call[0] == 'batch_mutate'
+                    for mutation in call[1].get(row_key, {}).get('Counter', [])
+                    if mutation.column_or_supercolumn and mutation.column_or_supercolumn.column.name == 'value']
+
+    def test_pending_writes_of_a_column_are_coalesced(self):
+        Counter('busy', value=0).save(async_=True) # keeps the only writer waiting at the gate
+        futures = [Counter('hot', value=i).save(async_=True) for i in xrange(5)]
+        self.assertEqual(self.writer.stats['coalesced'], 4 * 3) # value, created_at and last_modified
+
+        self.gated.gate.set()
+        for future in futures:
+            future.result(5)
+        self.assertEqual(self.written_values('hot'), ['4'])
+        self.assertEqual(Counter('hot').load().get('value'), 4)
+
+    def test_writer_survives_failing_batches(self):
+        class Odd(Exception):
+            pass
+        self.gated.fail = [Odd('boom')]
+        failed = Counter('first', value=1).save(async_=True)
+        self.gated.gate.set()
+        self.assertTrue(isinstance(failed.exception(5), Odd))
+
+        Counter('second', value=2).save(async_=True).result(5)
+        self.assertEqual(self.writer.stats['failed'], 1)
+        self.assertEqual(Counter('second').load().get('value'), 2)
+
+    def test_reconfiguring_closes_the_previous_writer(self):
+        future = Counter('last', value=7).save(async_=True)
+        threads = list(self.writer._threads)
+        self.gated.gate.set()
+        support.keyspace.configure_write_behind(workers=1)
+        self.assertTrue(future.done())
+        self.assertFalse([thread for thread in threads if thread.is_alive()])
+        self.assertRaises(TragedyException, self.writer.submit,
+                          Counter('late', value=1).get_save_mutation_map(), None)
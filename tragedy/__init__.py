@@ -16,6 +16,10 @@ from .columns import (BooleanField,
                       ByteField,
                       IntegerField,
                       FloatField,
+                      PackedIntegerField,
+                      PackedFloatField,
+                      PackedBooleanField,
+                      PackedTimeField,
                       DictField,
                       ListField,
                       TimestampField,
@@ -23,4 +27,5 @@ from .columns import (BooleanField,
                       AllIndex,
                       SecondaryIndex,
         		      JSONField,
+                      CompressedField,
                      )
\ No newline at end of file
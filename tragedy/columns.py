@@ -1,5 +1,9 @@
+import cPickle
+import marshal
+import struct
 import time
 import uuid
+import zlib
 from . import timestamp
 from datetime import datetime
 import simplejson as json
@@ -19,9 +23,14 @@ class ConvertAPI(BaseField):
     default = False
     unique = False
     _owner = None
+    cache_external = False # if rows may keep value_to_external results until the column changes
+    mutable_external = False # if value_to_external results can be changed in place, see BasicRow.store_resolved_changes
+    bulk_external = False # if values_to_external is faster than value_to_external one by one
+    numpy_dtype = None # for columnar results, see BasicRow.load_columnar
     
     def __init__(self, *args, **kwargs):
         self.mandatory = kwargs.pop('mandatory', True)
+        self.ttl = kwargs.pop('ttl', None) # seconds until Cassandra expires the column
     
     def to_internal(self, column_key, value):
         return self.key_to_internal(column_key), self.value_to_internal(value)
@@ -52,6 +61,9 @@ class ConvertAPI(BaseField):
     def value_to_external(self, value): # turn data into object for use outside of tragedy
         return value
 
+    def values_to_external(self, values): # many at once, e.g. for all rows of a load_multi
+        return [self.value_to_external(value) for value in values]
+
     def to_identity(self, column_key, value):
         return self.key_to_identity(column_key), self.value_to_identity(value)
 
@@ -88,6 +100,10 @@ class UnicodeField(Field):
         return column_key
 
 class TimeField(Field):    
+    cache_external = True
+    bulk_external = True
+    numpy_dtype = 'datetime64[us]'
+    
     def __init__(self, *args, **kwargs):
         self._autoset_on_create = kwargs.pop('autoset_on_create', False)    
         self._autoset_on_save = kwargs.pop('autoset_on_save', False) 
@@ -106,6 +122,9 @@ class TimeField(Field):
     def value_to_external(self, value):
         return timestamp.importUnix( float(value) )
 
+    def values_to_external(self, values):
+        return timestamp.importUnix_many(values)
+
     def value_to_internal(self, value):
         return str(timestamp.exportUnix(value, self._microseconds))
 
@@ -119,11 +138,11 @@ class TimestampField(Field):
     def __init__(self, *args, **kwargs):
         autoset_on_create = kwargs.pop('autoset_on_create', False)    
         if autoset_on_create:
-            self.default = lambda: uuid.uuid1().bytes
+            self.default = timestamp.newTimeUUID
         super(TimestampField, self).__init__(self, *args, **kwargs) 
         
     def value_to_display(self, value): # called before displaying data
-        return time.ctime(timestamp.fromUUID(uuid.UUID(bytes=value)))
+        return time.ctime((timestamp.uuidTime(value) - timestamp.UUID_UNIX_OFFSET) / 1e7)
 
     def value_to_external(self, value):
         return uuid.UUID(bytes=value).hex
@@ -157,13 +176,20 @@ class MissingField(Field):
         raise TragedyException('No Specification for Key %s' % (column_key,))
 
 class SuperField(Field):
+    """A super column as a dict of sub-column names to values, converted by subfield."""
+    def __init__(self, *args, **kwargs):
+        self.subfield = kwargs.pop('subfield', None) or Field(mandatory=False)
+        super(SuperField, self).__init__(*args, **kwargs)
+    
     def value_to_external(self, value):
-        return value
+        return dict((k, self.subfield.value_to_external(v)) for k, v in value.iteritems())
     
     def value_to_internal(self, value):
-        return value
+        return dict((k, self.subfield.value_to_internal(v)) for k, v in value.iteritems())
 
 class IntegerField(Field):
+    numpy_dtype = 'int64'
+    
     def value_to_external(self, value):
         return int(value)
     
@@ -171,6 +197,8 @@ class IntegerField(Field):
         return str(int(value))
 
 class FloatField(Field):
+    numpy_dtype = 'float64'
+    
     def value_to_external(self, value):
         return float(value)
     
@@ -178,6 +206,8 @@ class FloatField(Field):
         return str(float(value))
 
 class BooleanField(Field):    
+    numpy_dtype = 'bool'
+    
     def value_to_external(self, value):
         if value == True or value == "1":
             return True
@@ -186,12 +216,158 @@ class BooleanField(Field):
     def value_to_internal(self, value):
         return "1" if value else "0"
 
+# Packed fields store values in fixed-size binary instead of strings: smaller, faster
+# to convert, and integers and times sort correctly under LongType.
+_long_struct = struct.Struct('>q')
+_double_struct = struct.Struct('>d')
+
+class PackedIntegerField(Field):
+    """Integers as 8-byte big-endian signed longs, like Cassandra's LongType."""
+    numpy_dtype = 'int64'
+    
+    def value_to_external(self, value):
+        return _long_struct.unpack(value)[0]
+    
+    def value_to_internal(self, value):
+        return _long_struct.pack(int(value))
+
+class PackedFloatField(Field):
+    """Floats as 8-byte big-endian IEEE-754 doubles."""
+    numpy_dtype = 'float64'
+    
+    def value_to_external(self, value):
+        return _double_struct.unpack(value)[0]
+    
+    def value_to_internal(self, value):
+        return _double_struct.pack(float(value))
+
+class PackedBooleanField(Field):
+    """Booleans as a single byte."""
+    numpy_dtype = 'bool'
+    
+    def value_to_external(self, value):
+        return value == '\x01'
+    
+    def value_to_internal(self, value):
+        return '\x01' if value else '\x00'
+
+class PackedTimeField(TimeField):
+    """Like TimeField, but stores microseconds since the epoch as an 8-byte long."""
+    def value_to_display(self, value):
+        return str(self.value_to_external(value))
+    
+    def value_to_external(self, value):
+        return timestamp.importUnixMicro(_long_struct.unpack(value)[0])
+    
+    def values_to_external(self, values):
+        return timestamp.importUnixMicro_many([_long_struct.unpack(value)[0] for value in values])
+    
+    def value_to_internal(self, value):
+        return _long_struct.pack(timestamp.exportUnixMicro(value))
+
+class PickleSerializer(object):
+    """pickle protocol 2 - only for data nobody but us can write!"""
+    @staticmethod
+    def dumps(value):
+        return cPickle.dumps(value, 2)
+    
+    @staticmethod
+    def loads(value):
+        return cPickle.loads(value)
+
+# anything with dumps and loads can be passed as serializer, too
+serializers = {
+    'json': json,
+    'marshal': marshal,
+    'pickle': PickleSerializer,
+}
+
 class JSONField(Field):
+    """Stores structured values, as JSON unless another serializer is given. Rows keep the
+       decoded value, so repeated get()s don't decode again until the column is set, and
+       save() writes it back if it was changed in place."""
+    cache_external = True
+    mutable_external = True
+    
+    def __init__(self, *args, **kwargs):
+        serializer = kwargs.pop('serializer', 'json')
+        self.serializer = serializers[serializer] if isinstance(serializer, basestring) else serializer
+        super(JSONField, self).__init__(*args, **kwargs)
+    
+    def value_to_internal(self, value):
+        return self.serializer.dumps(value)
+    
+    def value_to_external(self, value):
+        return self.serializer.loads(value)
+
+# Header bytes of CompressedField values. Neither can start valid UTF-8, so text and
+# JSON written before compression was turned on still reads unchanged.
+COMPRESSED_ZLIB = '\xff'
+COMPRESSED_NONE = '\xfe' # raw value that would otherwise look like it has a header
+
+def compress_value(value, threshold=1024, level=6):
+    """Zlib-compresses value if it's at least threshold bytes and that actually saves space."""
+    if len(value) >= threshold:
+        packed = zlib.compress(value, level)
+        if len(packed) + 1 < len(value):
+            return COMPRESSED_ZLIB + packed
+    if value[:1] in (COMPRESSED_ZLIB, COMPRESSED_NONE):
+        return COMPRESSED_NONE + value
+    return value
+
+def decompress_value(value):
+    """
+    >>> decompress_value(compress_value('x' * 2000)) == 'x' * 2000
+    True
+    >>> decompress_value(compress_value('\\xffshort')), decompress_value('plain')
+    ('\\xffshort', 'plain')
+    """
+    header = value[:1]
+    if header == COMPRESSED_ZLIB:
+        return zlib.decompress(value[1:])
+    elif header == COMPRESSED_NONE:
+        return value[1:]
+    return value
+
+class CompressedField(Field):
+    """Wraps another field, e.g. CompressedField(UnicodeField()), and stores its values
+       zlib-compressed when they are at least threshold bytes long."""
+    cache_external = True
+    
+    def __init__(self, field, threshold=1024, level=6, *args, **kwargs):
+        self.field = field
+        self.threshold = threshold
+        self.level = level
+        self.mandatory = field.mandatory
+        self.ttl = field.ttl
+        self.default = field.default
+        self.unique = field.unique
+        self.mutable_external = field.mutable_external
+    
+    def set_owner_and_name(self, owner, name):
+        super(CompressedField, self).set_owner_and_name(owner, name)
+        self.field.set_owner_and_name(owner, name)
+    
+    def key_to_internal(self, column_key):
+        return self.field.key_to_internal(column_key)
+    
+    def key_to_external(self, column_key):
+        return self.field.key_to_external(column_key)
+    
     def value_to_internal(self, value):
-        return json.dumps(value)
+        return compress_value(self.field.value_to_internal(value), self.threshold, self.level)
     
     def value_to_external(self, value):
-        return json.loads(value)
+        return self.field.value_to_external(decompress_value(value))
+    
+    def value_to_display(self, value):
+        return self.field.value_to_display(decompress_value(value))
+    
+    def get_default(self):
+        return self.field.get_default()
+    
+    def value_for_saving(self, value):
+        return self.field.value_for_saving(value)
 
 DictField = JSONField
 ListField = JSONField
@@ -202,6 +378,7 @@ class ManualIndex(BaseField):
     def __init__(self, target_model, *args, **kwargs):
         self._target_model = target_model
         self.target_field = None
+        self.buckets = kwargs.pop('buckets', None) # 'day', 'week' or 'month', see TimeOrderedIndex
 
     def doresolve(self):
         if isinstance(self._target_model, basestring):
@@ -223,6 +400,7 @@ class SecondaryIndex(ManualIndex):
     autosetrow = False
     def __init__(self, target_field, *args, **kwargs):
         self.target_field = target_field
+        self.buckets = kwargs.pop('buckets', None)
 
     @property
     def target_model(self):
@@ -234,6 +412,8 @@ class AllIndex(ManualIndex):
     default_key = '!ALL!'
     def __init__(self, *args, **kwargs):
         self.target_field = self
+        self.shards = kwargs.pop('shards', None) # spread appends over this many rows
+        self.buckets = kwargs.pop('buckets', None)
     
     @property
     def target_model(self):
@@ -119,6 +119,8 @@ def connect_thread_local(servers=None, round_robin=True, framed_transport=False,
     return ThreadLocalConnection(servers, round_robin, framed_transport, timeout)
 
 class SingleConnection(object):
+    thread_safe = False
+    
     def __init__(self, servers, framed_transport, timeout):
         self._servers = servers
         self._client = None
@@ -174,6 +176,8 @@ class SingleConnection(object):
         raise NoServerAvailable()
 
 class ThreadLocalConnection(object):
+    thread_safe = True
+    
     def __init__(self, servers, round_robin, framed_transport, timeout):
         self._servers = servers
         self._queue = Queue()
@@ -187,8 +191,8 @@ class ThreadLocalConnection(object):
 
     def set_keyspace(self, keyspace):
         self._keyspace_set = keyspace
-        if self._local_client and not self._local_client.__dict__.get('keyspace_already_set'):
-            self.__getattr__('set_keyspace')(keyspace)
+        if getattr(self._local, 'client', None) is not None:
+            self._local.client.set_keyspace(keyspace)
 
     def __getattr__(self, attr):
         def client_call(*args, **kwargs):
@@ -232,8 +236,7 @@ class ThreadLocalConnection(object):
             try:
                 self._local.client, self._local.transport = create_client_transport(server, self._framed_transport, self._timeout)
                 if self._keyspace_set:
-                    self._local_client.__getattr__('set_keyspace')(self._keyspace_set)
-                    self._local_client.__dict__['keyspace_already_set'] = True
+                    self._local.client.set_keyspace(self._keyspace_set)
                 return
             except (Thrift.TException, socket.timeout, socket.error), exc:
                 continue
@@ -5,3 +5,11 @@ class TragedyException(Exception):
 class NoServerAvailable(TragedyException):
     pass
 
+class FanoutError(TragedyException):
+    """A fan-out failed. The first done rows are written for sure; resume
+       with the same column_key and skip=done."""
+    def __init__(self, done, column_key, cause):
+        TragedyException.__init__(self, 'Fan-out failed after %s rows: %r' % (done, cause))
+        self.done = done
+        self.column_key = column_key
+        self.cause = cause
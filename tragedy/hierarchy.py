@@ -1,3 +1,4 @@
+import hashlib
 from cassandra.ttypes import (KsDef,)
 from .datastructures import (OrderedDict,)
 from .util import (CASPATHSEP,
@@ -5,6 +6,7 @@ from .util import (CASPATHSEP,
                    popmulti,
                   )
 from . import connection
+from .writebehind import (WriteBehind,)
 
 cmcache = CrossModelCache()
 
@@ -33,6 +35,9 @@ class Cluster(object):
         self.keyspaces = OrderedDict()
         self.name = name
         
+        # has to match the partitioner in the cluster's storage-conf, see token()
+        self.partitioner = 'org.apache.cassandra.dht.RandomPartitioner'
+        
         cmcache.append('clusters', self)
     
     def setclient(self, client):
@@ -40,6 +45,17 @@ class Cluster(object):
     
     def registerKeyspace(self, name, keyspc):
         self.keyspaces[name] = keyspc
+    
+    def token(self, row_key):
+        """The token our partitioner places row_key at, as thrift's KeyRange expects it."""
+        if self.partitioner.endswith('.RandomPartitioner'):
+            token = int(hashlib.md5(row_key).hexdigest(), 16)
+            if token >= 2**127: # java's BigInteger reads the digest as signed
+                token -= 2**128
+            return str(abs(token))
+        elif self.partitioner.endswith('.ByteOrderedPartitioner'):
+            return row_key.encode('hex')
+        return row_key # OrderPreservingPartitioner and CollatingOrderPreservingPartitioner
         
     def __str__(self):
         return self.name
@@ -50,6 +66,7 @@ class Keyspace(object):
         self.name = name
         self.cluster = cluster
         self._client = None
+        self._write_behind = None
         self._first_iteration_in_this_cycle = False
         cluster.registerKeyspace(self.name, self)
         
@@ -60,7 +77,10 @@ class Keyspace(object):
 
     def connect(self, *args, **kwargs):
         newkwargs = popmulti(kwargs, *possible_validate_args )
-        self._client = connection.connect(*args, **kwargs)
+        if kwargs.pop('thread_local', False): # one connection per thread, needed for parallel writes
+            self._client = connection.connect_thread_local(*args, **kwargs)
+        else:
+            self._client = connection.connect(*args, **kwargs)
         
         for model in self.models.values():
             model._init_stage_two()
@@ -75,6 +95,24 @@ class Keyspace(object):
         assert self._client, "Keyspace doesn't have a connection."
         return self._client
 
+    def configure_write_behind(self, **kwargs):
+        """Sets up the writer behind save(async_=True), see WriteBehind for the options.
+           A previous writer writes what it has pending and stops first."""
+        if self._write_behind:
+            self._write_behind.close()
+        self._write_behind = WriteBehind(self.getclient, **kwargs)
+        return self._write_behind
+
+    def get_write_behind(self):
+        if not self._write_behind:
+            self.configure_write_behind()
+        return self._write_behind
+
+    def flush(self, timeout=None):
+        """Waits until all asynchronous saves so far are written."""
+        if self._write_behind:
+            self._write_behind.flush(timeout)
+
     def path(self):
         return u'%s%s%s' % (self.cluster.name, CASPATHSEP, self.name)
 
@@ -1,4 +1,5 @@
-from .rows import DictRow, RowKey
+from .rows import DictRow, RowKey, prefetch_related
+from .datastructures import OrderedDict
 from .columns import (ByteField, 
                       TimeField,
                       ManualIndex,
@@ -6,14 +7,31 @@ from .columns import (ByteField,
                       ForeignKey,
                       BaseField,
                      )
-import uuid
-from .exceptions import TragedyException
+import functools
+import heapq
+import itertools
+import Queue
+import threading
+import zlib
+from cassandra.ttypes import Clock
+from . import timestamp
+from .exceptions import (TragedyException,
+                         FanoutError,
+                        )
 
 from .hierarchy import cmcache
+from .util import (merge_mutation_maps,
+                   warn,
+                   unhandled_exception_handler,
+                   ExpiringCache,
+                  )
+
+count_cache = ExpiringCache()
 
 class Model(DictRow):
     _auto_timestamp = True
     __abstract__ = True
+    _generated_indexes = () # the autosaved indexes, which deleting us removes us from
     
     def __init__(self, *args, **kwargs):
         DictRow.__init__(self, *args, **kwargs)
@@ -47,6 +65,7 @@ class Model(DictRow):
     
     @classmethod
     def _activate_autoindexes(cls):
+        cls._generated_indexes = []
         for key, value in cls.__dict__.items():
             if isinstance(value, ManualIndex):
                 # print 'SCREAM', cls, key, value, value.target_field, 'Auto_%s_%s' % (value.target_model._column_family, key) 
@@ -57,6 +76,8 @@ class Model(DictRow):
                     target_fieldname = None
                 default_key = getattr(value, 'default_key', None)
                 autosetrow = getattr(value, 'autosetrow', False)
+                shards = getattr(value, 'shards', None)
+                buckets = getattr(value, 'buckets', None)
                 
                 class ManualIndexImplementation(GeneratedIndex):
                     _column_family = 'Auto_%s_%s' % (cls._column_family, key)
@@ -65,6 +86,9 @@ class Model(DictRow):
                     _target_fieldname = target_fieldname
                     _default_key = default_key
                     _autosetrow = autosetrow
+                    _shards = shards
+                    _buckets = buckets
+                    _sweep_fieldname = target_fieldname if isinstance(value, SecondaryIndex) else None
                     
                     def __init__(self, *args, **kwargs):
                         TimeOrderedIndex.__init__(self, *args, **kwargs)
@@ -76,22 +100,35 @@ class Model(DictRow):
                                 self.row_key = self._default_key
                     
                     @classmethod
-                    def target_saved(cls, instance):
+                    def target_saved(cls, instance, clock=None):
                         # print 'AUTOSAVE', cls._column_family, cls._index_name, getattr(cls,'_target_fieldname', None), instance.row_key, instance
                         default_key = cls._default_key
                         # print 'WORKING WITH', cls._column_family, cls._target_fieldname, default_key
                         
+                        # only touch the index if this save can have changed what it holds;
+                        # what we return is written in the same batch_mutate as instance
                         if default_key:
-                            cls(default_key).append(instance).save()
-                        else:
+                            if instance.is_new():
+                                index = cls(default_key).append(instance, ttl=instance._default_ttl)
+                                return index.get_mutation_map(index.row_key, clock=clock)
+                        elif instance.is_new() or cls._target_fieldname in instance.column_changed:
                             seckey = instance.get(cls._target_fieldname)
                             mandatory = getattr(getattr(instance, cls._target_fieldname), 'mandatory', False)
-                            if seckey:
-                                cls( seckey ).append(instance).save()
-                            elif (not seckey) and mandatory:
+                            if (not seckey) and mandatory:
                                 raise TragedyException('Mandatory Secondary Field %s not present!' % (cls._target_fieldname,))
-                            else:
-                                pass # not mandatory
+                            
+                            mumap = {}
+                            if seckey:
+                                index = cls( seckey ).append(instance, ttl=instance.get_ttl_for_columnkey(cls._target_fieldname))
+                                mumap = index.get_mutation_map(index.row_key, clock=clock)
+                            # the old value's entry goes away along with it
+                            previous = instance.column_previous.get(cls._target_fieldname)
+                            if previous is not None:
+                                previous = instance.get_spec_for_columnkey(cls._target_fieldname).value_to_external(previous)
+                                if previous != seckey:
+                                    merge_mutation_maps(mumap, cls.get_removal_mutation_map(previous, instance.row_key,
+                                                                                            clock=clock))
+                            return mumap
                 
                 # print 'OHAIFUCK TARGETMODEL', cls._column_family, value.target_model 
                 setattr(ManualIndexImplementation, cls._column_family.lower(), RowKey())
@@ -100,7 +137,75 @@ class Model(DictRow):
                 # print getattr(cls, key)
                 
                 if getattr(value, 'autosave', False):
-                    cls.save_hooks.add(ManualIndexImplementation.target_saved) 
+                    cls.mutation_hooks.add(ManualIndexImplementation.target_saved)
+                    cls._generated_indexes.append(ManualIndexImplementation)
+
+    @classmethod
+    def get_rows_deletion_map(cls, row_keys, clock=None):
+        clock = clock or Clock(timestamp=cls._timestamp_func())
+        mumap = super(Model, cls).get_rows_deletion_map(row_keys, clock=clock)
+        merge_mutation_maps(mumap, cls.get_index_removal_map(row_keys, clock=clock))
+        return mumap
+
+    @classmethod
+    def get_index_removal_map(cls, row_keys, clock=None):
+        """The mutation_map that removes the rows row_keys from our generated indexes.
+           The fields SecondaryIndexes need are read with one multiget."""
+        fieldnames = [index._target_fieldname for index in cls._generated_indexes if not index._default_key]
+        rows = []
+        if fieldnames and row_keys:
+            rows = list(cls.load_multi(keys=list(row_keys), ordered=False, column_names=fieldnames))
+        
+        mumap = {}
+        for index in cls._generated_indexes:
+            if not index._default_key:
+                pairs = [(index(row.get(index._target_fieldname)).row_key, row.row_key) for row in rows
+                             if row.get(index._target_fieldname)] # the row target_saved appended to
+            elif isinstance(index._default_key, basestring):
+                pairs = [(index._default_key, row_key) for row_key in row_keys]
+            else:
+                continue # rows of instances, we can't know which
+            merge_mutation_maps(mumap, index.get_removals_mutation_map(pairs, clock=clock))
+        return mumap
+
+class ReverseLookup(DictRow):
+    """Maps the targets stored in a unique Index row back to the column keys
+       they are stored under, so uniqueness is a single column read."""
+    __abstract__ = True
+    _order_by = 'BytesType'
+    _default_field = ByteField(mandatory=False)
+    _index = None # the Index we look up entries of
+    _populated = False # see is_populated
+    _populated_row_key = '!POPULATED!'
+
+    @classmethod
+    def lookup(cls, row_key, target):
+        columns = cls.get_slice(key=row_key, column_names=[target])
+        if columns:
+            return columns[0][1]
+        return None
+
+    @classmethod
+    def is_populated(cls):
+        """True once we know every entry of our Index. Entries written before reverse
+           lookups existed are missing until devtools/build_reverse_lookups.py ran."""
+        if not cls._populated:
+            cls._populated = bool(cls.get_slice(key=cls._populated_row_key, column_names=['populated']))
+        return cls._populated
+
+    @classmethod
+    def mark_populated(cls):
+        marker = cls(cls._populated_row_key)
+        marker._update([('populated', '1')])
+        marker.save()
+        cls._populated = True
+
+    @classmethod
+    def register_columnfamiliy_with_cassandra(cls):
+        super(ReverseLookup, cls).register_columnfamiliy_with_cassandra()
+        for row_key in cls._index.iter_row_keys(page_size=1):
+            return # our Index has entries from before us, they need building
+        cls.mark_populated()
 
 class Index(DictRow):
     """A row which doesn't care about column names, and that can be appended to."""
@@ -108,6 +213,10 @@ class Index(DictRow):
     # _default_field = ByteField()
     _order_by = 'TimeUUIDType'
     _ordered = True
+    _reverse_lookup = None
+    _shards = None # if set, columns are spread over '<row_key>:<n>' rows by target
+    _buckets = None # see TimeOrderedIndex
+    _count_cache_ttl = None # seconds to cache count() results for
 
     @classmethod
     def _init_class(cls, *args, **kwargs):
@@ -115,25 +224,440 @@ class Index(DictRow):
         if hasattr(cls, 'targetmodel'):
             cls._default_field = cls.targetmodel
             del cls.targetmodel
+        if cls._default_field.unique and cls._order_by == 'TimeUUIDType':
+            cls._init_reverse_lookup()
+
+    @classmethod
+    def _init_reverse_lookup(cls):
+        class ReverseLookupImplementation(ReverseLookup):
+            _column_family = '%s_Reverse' % (cls._column_family,)
+            _keyspace = cls._keyspace
+            _index = cls
+        setattr(ReverseLookupImplementation, 'index_row_key', RowKey())
+        cls._reverse_lookup = ReverseLookupImplementation
 
     def is_unique(self, target):
         if self._order_by != 'TimeUUIDType':
             return True
-            
-        MAXCOUNT = 20000000
-        self.load(count=MAXCOUNT) # XXX: we will blow up here at some point
-                                  # i don't know where the real limit is yet.
-        assert len(self.column_values) < MAXCOUNT - 1, 'Too many keys to enforce sorted uniqueness!'
+        
         mytarget = self._default_field.value_to_internal(target)
-        if mytarget in self.itervalues():
+        for column_key in self.column_changed: # appended, but not saved yet
+            if self.column_values.get(column_key) == mytarget:
+                return False
+        
+        assert self._reverse_lookup, 'Uniqueness needs a reverse lookup - is our ForeignKey unique?'
+        shard_row_key = self.shard_row_key(self.row_key, mytarget)
+        if self._reverse_lookup.lookup(shard_row_key, mytarget) is not None:
             return False
+        if self._reverse_lookup.is_populated():
+            return True
+        
+        # the reverse lookup may not know older entries yet, so look at the row itself
+        if not self._reverse_lookup.__dict__.get('_warned_unpopulated'):
+            warn('%s is not populated yet, uniqueness checks scan %s rows until '
+                 'devtools/build_reverse_lookups.py ran.' % (self._reverse_lookup._column_family, self._column_family))
+            self._reverse_lookup._warned_unpopulated = True
+        for column_key, value in self.iter_row(shard_row_key, page_size=1000):
+            if value == mytarget:
+                return False
         return True
+
+    @classmethod
+    def shard_row_key(cls, row_key, target):
+        """The row that stores target. The same target always lands on the same shard."""
+        if not cls._shards:
+            return row_key
+        return '%s:%d' % (row_key, (zlib.crc32(target) & 0xffffffff) % cls._shards)
+
+    @classmethod
+    def shard_row_keys(cls, row_key):
+        if not cls._shards:
+            return [row_key]
+        return ['%s:%d' % (row_key, shard) for shard in xrange(cls._shards)]
+
+    def get_mutation_map(self, save_row_key, column_keys=None, clock=None):
+        clock = clock or Clock(timestamp=self._timestamp_func())
+        self.forget_counts(save_row_key)
+        rows = OrderedDict()
+        for column_key in (column_keys or self.column_changed.keys()):
+            target = self.column_values[column_key]
+            rows.setdefault(self.shard_row_key(save_row_key, target), []).append(column_key)
         
-    def get_next_column_key(self):
-        assert self._order_by == 'TimeUUIDType', 'Append makes no sense for sort order %s' % (self._order_by,)
-        return uuid.uuid1().bytes
+        mumap = {}
+        for row_key, row_column_keys in rows.iteritems():
+            if self._reverse_lookup:
+                reverse = self._reverse_lookup(row_key)
+                reverse._update([(self.column_values[ck], ck) for ck in row_column_keys])
+                for ck in row_column_keys: # expire along with the column they point to
+                    reverse.column_ttl[self.column_values[ck]] = self.get_ttl_for_columnkey(ck)
+                merge_mutation_maps(mumap, reverse.get_mutation_map(row_key, clock=clock))
+            merge_mutation_maps(mumap, self.get_row_mutation_map(row_key, row_column_keys, clock=clock))
+        
+        if self.column_deleted and column_keys is None:
+            for column_key, target in self.column_deleted.iteritems():
+                if target is None: # never loaded, so we can't know its shard or reverse entry
+                    assert not self._shards, 'Can only delete loaded columns from a sharded Index.'
+                    merge_mutation_maps(mumap, self.get_deletion_map(self.column_row_key(save_row_key, column_key),
+                                                                     [column_key], clock=clock))
+                else:
+                    merge_mutation_maps(mumap, self.get_removal_mutation_map(save_row_key, target,
+                                                                             column_key=column_key, clock=clock))
+        return mumap
+
+    def get_row_mutation_map(self, row_key, column_keys, clock=None):
+        """Mutations that store column_keys in the (shard) row row_key."""
+        return super(Index, self).get_mutation_map(row_key, column_keys=column_keys, clock=clock)
+
+    @classmethod
+    def column_row_key(cls, row_key, column_key):
+        """The row that stores column_key of the (shard) row row_key."""
+        return row_key
+
+    @classmethod
+    def get_removal_mutation_map(cls, row_key, target, column_key=None, clock=None):
+        """Builds the mutation_map that removes target from our row row_key, along with its
+           reverse lookup entry. Without column_key, the reverse lookup has to tell where
+           target is stored; if it doesn't know, there's nothing to remove."""
+        shard_row_key = cls.shard_row_key(row_key, target)
+        if column_key is None and cls._reverse_lookup:
+            column_key = cls._reverse_lookup.lookup(shard_row_key, target)
+        if column_key is None:
+            return {}
+        
+        cls.forget_counts(row_key)
+        clock = clock or Clock(timestamp=cls._timestamp_func())
+        mumap = cls.get_deletion_map(cls.column_row_key(shard_row_key, column_key), [column_key], clock=clock)
+        if cls._reverse_lookup:
+            merge_mutation_maps(mumap, cls._reverse_lookup.get_deletion_map(shard_row_key, [target], clock=clock))
+        return mumap
+
+    @classmethod
+    def get_removals_mutation_map(cls, pairs, clock=None):
+        """get_removal_mutation_map for many (row_key, target) pairs, with one multiget
+           of the reverse lookup for all their column keys."""
+        if not cls._reverse_lookup:
+            return {}
+        shards = [(cls.shard_row_key(row_key, target), row_key, target) for row_key, target in pairs]
+        if not shards:
+            return {}
+        found = cls._reverse_lookup.multiget_slice(keys=list(set(shard[0] for shard in shards)),
+                                                   column_names=list(set(shard[2] for shard in shards)))
+        found = dict((shard_row_key, dict(columns)) for shard_row_key, columns in found)
+        
+        clock = clock or Clock(timestamp=cls._timestamp_func())
+        mumap = {}
+        for shard_row_key, row_key, target in shards:
+            column_key = found.get(shard_row_key, {}).get(target)
+            if column_key is not None:
+                merge_mutation_maps(mumap, cls.get_removal_mutation_map(row_key, target, column_key=column_key,
+                                                                        clock=clock))
+        return mumap
+
+    @classmethod
+    def get_rows_deletion_map(cls, row_keys, clock=None):
+        """Deletes all physical rows of our rows row_keys, and their reverse lookups.
+           The physical rows of all of them are looked up with one multiget."""
+        clock = clock or Clock(timestamp=cls._timestamp_func())
+        mumap = {}
+        for row_key, physical_row_keys in cls.physical_row_keys_multi(row_keys).iteritems():
+            cls.forget_counts(row_key)
+            for physical_row_key in physical_row_keys:
+                merge_mutation_maps(mumap, cls.get_deletion_map(physical_row_key, clock=clock))
+            if cls._reverse_lookup:
+                for shard_row_key in cls.shard_row_keys(row_key):
+                    merge_mutation_maps(mumap, cls._reverse_lookup.get_deletion_map(shard_row_key, clock=clock))
+        return mumap
+
+    @classmethod
+    def get_emptied_row_map(cls, shard_row_key, column_key, clock=None):
+        """Mutations that forget the physical row that stored column_key of the (shard)
+           row shard_row_key, once trim() deleted all its columns."""
+        return {}
+
+    def trim(self, keep_latest=1000, page_size=500, consistency_level=None):
+        """Deletes all but our keep_latest newest columns (across shards and buckets), with
+           one batch_mutate per page_size deleted columns. Returns the number deleted."""
+        merged = self.iter_merged(self.shard_row_keys(self.row_key), page_size=page_size)
+        kept = set(self.column_row_key(self.shard_row_key(self.row_key, target), column_key)
+                       for column_key, target in itertools.islice(merged, keep_latest))
+        clock = Clock(timestamp=self._timestamp_func())
+        emptied = {}
+        trimmed = 0
+        while True:
+            page = list(itertools.islice(merged, page_size))
+            if not page:
+                break
+            mumap = {}
+            for column_key, target in page:
+                merge_mutation_maps(mumap, self.get_removal_mutation_map(self.row_key, target,
+                                                                         column_key=column_key, clock=clock))
+                self.column_values.pop(column_key, None)
+                self.ordered_columnkeys.discard(column_key)
+                
+                shard_row_key = self.shard_row_key(self.row_key, target)
+                physical_row_key = self.column_row_key(shard_row_key, column_key)
+                if physical_row_key not in kept and physical_row_key not in emptied:
+                    emptied[physical_row_key] = self.get_emptied_row_map(shard_row_key, column_key, clock=clock)
+            self.getclient().batch_mutate(mutation_map=mumap, consistency_level=self._wcl(consistency_level))
+            trimmed += len(page)
+        
+        # only once all their columns are gone, or a failed trim could hide the rest
+        mumap = {}
+        for emptied_map in emptied.itervalues():
+            merge_mutation_maps(mumap, emptied_map)
+        if mumap:
+            self.getclient().batch_mutate(mutation_map=mumap, consistency_level=self._wcl(consistency_level))
+        return trimmed
+
+    @classmethod
+    def iter_row(cls, row_key, page_size=100, reverse=True, **kwargs):
+        """Yields the (column_key, value) pairs of the (shard) row row_key, paged."""
+        return cls.iter_rows([row_key], page_size=page_size, reverse=reverse, **kwargs)[0]
+
+    @classmethod
+    def iter_rows(cls, row_keys, page_size=100, reverse=True, **kwargs):
+        """iter_row for each of the (shard) rows row_keys, as a list of iterators.
+           The first pages of all rows are read with one multiget_slice."""
+        if not row_keys:
+            return []
+        rows = cls.xmultiget_slice(keys=list(row_keys), page_size=page_size, reverse=reverse, **kwargs)
+        return [rows[row_key] for row_key in row_keys]
+
+    def build_reverse_lookup(self, page_size=1000):
+        """Writes reverse lookup entries for everything already stored in this row.
+           Only needed once for rows written before the reverse lookup existed."""
+        assert self._reverse_lookup, 'No reverse lookup for %s' % (self.__class__.__name__,)
+        count = 0
+        reverse = self._reverse_lookup(self.row_key)
+        for column_key, target in self.iter_row(self.row_key, page_size=page_size, reverse=False):
+            reverse._update([(target, column_key)])
+            count += 1
+            if len(reverse.column_changed) >= page_size:
+                reverse.save()
+                reverse = self._reverse_lookup(self.row_key)
+        if reverse.column_changed:
+            reverse.save()
+        return count
+
+    def load(self, *args, **kwargs):
+        if not (self._shards or self._buckets):
+            return super(Index, self).load(*args, **kwargs)
+        count = kwargs.pop('count', 10000)
+        merged = self.iter_merged(self.shard_row_keys(self.row_key), page_size=min(count, 1000), **kwargs)
+        self._update(itertools.islice(merged, count), _for_loading=True)
+        return self
+
+    def iter_pages(self, page_size=100, **kwargs):
+        """Yields our columns page_size at a time, newest first, as loaded instances of our class."""
+        merged = self.iter_merged(self.shard_row_keys(self.row_key), page_size=page_size, **kwargs)
+        while True:
+            page = self.__class__(self.row_key)
+            page._update(itertools.islice(merged, page_size), _for_loading=True)
+            if not page.column_values:
+                return
+            yield page
+
+    def iter_columns(self, page_size=1000, access_mode='to_external', **kwargs):
+        if not (self._shards or self._buckets):
+            return super(Index, self).iter_columns(page_size=page_size, access_mode=access_mode, **kwargs)
+        merged = self.iter_merged(self.shard_row_keys(self.row_key), page_size=page_size, **kwargs)
+        return self._convert_columns(merged, access_mode)
+
+    def between(self, start=None, end=None, limit=1000, reverse=True):
+        """Loads (at most limit of) our columns whose TimeUUIDs lie between the UTC datetimes
+           start and end, newest first unless reverse=False. None leaves that end open.
+           The range is sliced by Cassandra, so columns outside it are never read."""
+        assert self._order_by == 'TimeUUIDType', 'Time ranges make no sense for sort order %s' % (self._order_by,)
+        lowest = timestamp.exportTimeUUID(start, lowest=True) if start else ''
+        highest = timestamp.exportTimeUUID(end, lowest=False) if end else ''
+        if reverse:
+            bounds = dict(start=highest, finish=lowest)
+        else:
+            bounds = dict(start=lowest, finish=highest)
+        
+        merged = self.iter_merged(self.shard_row_keys(self.row_key), page_size=min(limit, 1000), reverse=reverse, **bounds)
+        self._update(itertools.islice(merged, limit), _for_loading=True)
+        return self
+
+    def since(self, start, limit=1000, reverse=True):
+        """Loads our columns that are newer than the UTC datetime start."""
+        return self.between(start, None, limit=limit, reverse=reverse)
+
+    def count(self, cache_ttl=None, **kwargs):
+        """Number of our columns, counted by Cassandra without loading them. Takes the
+           same slice bounds (start, finish, count) as paging. If cache_ttl (or our
+           _count_cache_ttl) is set, counts are cached client side for that many seconds."""
+        return self.count_multi([self.row_key], cache_ttl=cache_ttl, **kwargs)[self.row_key]
+
+    @classmethod
+    def count_multi(cls, keys, cache_ttl=None, **kwargs):
+        """count() for the rows keys of this Index with one multiget_count. Returns a dict of row key to count."""
+        if cache_ttl is None:
+            cache_ttl = cls._count_cache_ttl
+        bounds = tuple(sorted(kwargs.items()))
+        
+        counts = OrderedDict()
+        for row_key in keys:
+            counts[row_key] = count_cache.retrieve((cls._column_family, row_key, bounds)) if cache_ttl else None
+        
+        missing = cls.physical_row_keys_multi([row_key for row_key, count in counts.iteritems() if count is None], **kwargs)
+        physical_keys = list(itertools.chain.from_iterable(missing.itervalues()))
+        physical_counts = cls.multiget_count(keys=physical_keys, **kwargs) if physical_keys else {}
+        for row_key, row_keys in missing.iteritems():
+            counts[row_key] = sum(physical_counts.get(physical_key, 0) for physical_key in row_keys)
+            if 'count' in kwargs: # each physical row was limited on its own
+                counts[row_key] = min(counts[row_key], kwargs['count'])
+            if cache_ttl:
+                count_cache.store((cls._column_family, row_key, bounds), counts[row_key], cache_ttl,
+                                  group=(cls._column_family, row_key))
+        return counts
+
+    @classmethod
+    def forget_counts(cls, row_key):
+        """Drops the cached counts of our row row_key, because it's being written."""
+        count_cache.drop_group((cls._column_family, row_key))
+
+    @classmethod
+    def physical_row_keys(cls, row_key, **kwargs):
+        """The rows that actually store the columns of our row row_key."""
+        return cls.physical_row_keys_multi([row_key], **kwargs)[row_key]
+
+    @classmethod
+    def physical_row_keys_multi(cls, row_keys, **kwargs):
+        """physical_row_keys for many rows, as a dict of row key to physical row keys."""
+        return OrderedDict((row_key, cls.shard_row_keys(row_key)) for row_key in row_keys)
+
+    @classmethod
+    def iter_merged(cls, row_keys, page_size=100, reverse=True, **kwargs):
+        """Lazily merges several rows of this Index into one stream of (column_key, value)
+           pairs in TimeUUID order, newest first unless reverse=False. Each row is read
+           page_size columns at a time, and only when the merge gets to it."""
+        assert cls._order_by == 'TimeUUIDType', 'Merging makes no sense for sort order %s' % (cls._order_by,)
+        sign = -1 if reverse else 1
+        heap = []
+        for i, columns in enumerate(cls.iter_rows(row_keys, page_size=page_size, reverse=reverse, **kwargs)):
+            for column in columns:
+                heap.append((sign * timestamp.uuidTime(column[0]), i, column, columns))
+                break
+        heapq.heapify(heap)
+        
+        while heap:
+            column, columns = heap[0][2:]
+            yield column
+            for column in columns:
+                heapq.heapreplace(heap, (sign * timestamp.uuidTime(column[0]), heap[0][1], column, columns))
+                break
+            else:
+                heapq.heappop(heap)
+
+    @classmethod
+    def build_reverse_lookups(cls, page_size=1000):
+        """build_reverse_lookup for every row of this Index."""
+        count = 0
+        for row_key in cls.iter_index_row_keys(page_size=page_size):
+            count += cls(row_key).build_reverse_lookup(page_size=page_size)
+        cls._reverse_lookup.mark_populated()
+        return count
+        
+    @classmethod
+    def get_next_column_key(cls):
+        assert cls._order_by == 'TimeUUIDType', 'Append makes no sense for sort order %s' % (cls._order_by,)
+        return timestamp.newTimeUUID()
+
+    def iter_target_keys(self, page_size=500):
+        """Streams the row keys we point to, newest first, page_size at a time."""
+        for column_key, value in self.iter_merged(self.shard_row_keys(self.row_key), page_size=page_size):
+            yield value
+
+    @classmethod
+    def fanout(cls, target, row_keys, batch_rows=500, workers=8, progress=None,
+               column_key=None, skip=0, ttl=None, consistency_level=None):
+        """Appends target to each of the rows row_keys of this Index, batch_rows rows per
+           batch_mutate. row_keys can be any iterable, e.g. iter_target_keys() of another Index,
+           and is only consumed as fast as batches get written. With a thread-local connection
+           up to workers batches are written in parallel, otherwise one at a time.
+           
+           progress(done) is called with the number of rows known to be written. Every row
+           gets the same column key, so repeating a fan-out doesn't duplicate anything: on
+           failure a FanoutError says how many rows are done, and the fan-out can be resumed
+           by passing its column_key and skip=done. ttl works like for append."""
+        column_key = column_key or cls.get_next_column_key()
+        target = cls._default_field.value_to_internal(target)
+        if not cls.getclient().thread_safe:
+            workers = 1
         
-    def append(self, target):
+        row_keys = iter(row_keys)
+        if skip:
+            row_keys = itertools.islice(row_keys, skip, None)
+        batches = iter(lambda: list(itertools.islice(row_keys, batch_rows)), [])
+        
+        tracker = FanoutProgress(skip, progress)
+        write = functools.partial(cls._fanout_batch, target, column_key, ttl=ttl, consistency_level=consistency_level)
+        if workers <= 1:
+            for number, batch in enumerate(batches):
+                try:
+                    write(batch)
+                    tracker.finished(number, len(batch))
+                except Exception, e:
+                    raise FanoutError(tracker.done, column_key, e)
+            return tracker.done
+        
+        queue = Queue.Queue(maxsize=workers) # bounds how far we read ahead in row_keys
+        errors = []
+        def worker():
+            while True:
+                item = queue.get()
+                if item is None:
+                    return
+                number, batch = item
+                if errors: # don't bother after the first failure
+                    continue
+                try: # a dead worker would leave the queue.put below blocked for good
+                    write(batch)
+                    tracker.finished(number, len(batch))
+                except Exception, e:
+                    errors.append(e)
+        
+        threads = [threading.Thread(target=worker) for i in xrange(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for item in enumerate(batches):
+                if errors:
+                    break
+                queue.put(item)
+        finally:
+            for thread in threads:
+                queue.put(None)
+            for thread in threads:
+                thread.join()
+        
+        if errors:
+            raise FanoutError(tracker.done, column_key, errors[0])
+        return tracker.done
+
+    @classmethod
+    def _fanout_batch(cls, target, column_key, row_keys, ttl=None, consistency_level=None):
+        if cls._reverse_lookup: # one read for the uniqueness of the whole batch
+            shard_row_keys = OrderedDict((cls.shard_row_key(row_key, target), row_key) for row_key in row_keys)
+            existing = cls._reverse_lookup.multiget_slice(keys=shard_row_keys.keys(), column_names=[target])
+            known = set(shard_row_keys[key] for key, columns in existing if columns)
+            row_keys = [row_key for row_key in row_keys if row_key not in known]
+        
+        mumap = {}
+        clock = Clock(timestamp=cls._timestamp_func())
+        for row_key in row_keys:
+            row = cls(row_key)
+            row._update([(column_key, target)])
+            if ttl is not None:
+                row.column_ttl[column_key] = ttl
+            merge_mutation_maps(mumap, row.get_mutation_map(row_key, clock=clock))
+        if mumap:
+            cls.getclient().batch_mutate(mutation_map=mumap, consistency_level=cls._wcl(consistency_level))
+        
+    def append(self, target, ttl=None):
+        """Adds target as our newest column. With ttl, Cassandra drops it again after ttl seconds."""
         assert self._order_by == 'TimeUUIDType', 'Append makes no sense for sort order %s' % (self._order_by,)
         if (self._default_field.unique and not self.is_unique(target)):
             return self
@@ -146,6 +670,21 @@ class Index(DictRow):
         column_key = self.get_next_column_key()
 
         self._update( [(column_key, target)] )
+        if ttl is not None:
+            self.column_ttl[column_key] = ttl
+        return self
+
+    def extend(self, targets, ttl=None):
+        """append for many targets at once, with one bulk of column keys."""
+        assert self._order_by == 'TimeUUIDType', 'Append makes no sense for sort order %s' % (self._order_by,)
+        targets = list(targets)
+        for column_key, target in zip(timestamp.newTimeUUIDs(len(targets)), targets):
+            if self._default_field.unique and not self.is_unique(target):
+                continue
+            assert isinstance(target, self._default_field.foreign_class), "Trying to store ForeignKey of wrong type!"
+            self._update( [(column_key, self._default_field.value_to_internal(target))] )
+            if ttl is not None:
+                self.column_ttl[column_key] = ttl
         return self
 
     def loadIterItems(self):
@@ -156,16 +695,284 @@ class Index(DictRow):
             return self._default_field.foreign_class.load_multi(keys=self.values()) #orderdata=self.keys())
         return []
 
-    def resolve(self):
-        return self.loadIterValues()
+    def resolve(self, prefetch=None):
+        """Loads the rows we point to. prefetch is a list of ForeignKey paths like
+           ['author', 'author.avatar'] to load along with them, see prefetch_related."""
+        if not prefetch:
+            return self.loadIterValues()
+        return prefetch_related(list(self.loadIterValues()), prefetch)
+
+    def iter_resolved(self, chunk_size=500):
+        """Streams the rows we point to, newest first, without holding more than
+           a few chunks of chunk_size rows (and index columns) in memory."""
+        return self._default_field.foreign_class.load_multi(keys=self.iter_target_keys(page_size=chunk_size),
+                                                            chunk_size=chunk_size)
 
     def __iter__(self):
         for row_key in self.itervalues():
             yield self._default_field.foreign_class(row_key=row_key)
 
+    @classmethod
+    def iter_index_row_keys(cls, page_size=1000):
+        """Yields the keys of all (shard) rows of this Index."""
+        return cls.iter_row_keys(page_size=page_size)
+
+    @classmethod
+    def unshard_row_key(cls, shard_row_key):
+        """The row key a (shard) row key of iter_index_row_keys belongs to."""
+        if not cls._shards:
+            return shard_row_key
+        return shard_row_key.rsplit(':', 1)[0]
+
+bucket_formats = {
+    'day':   lambda t: t.strftime('%Y%m%d'),
+    'week':  lambda t: '%04dW%02d' % t.isocalendar()[:2],
+    'month': lambda t: t.strftime('%Y%m'),
+}
+
+class BucketDirectory(DictRow):
+    """Lists the time buckets a bucketed TimeOrderedIndex row has been written to."""
+    __abstract__ = True
+    _order_by = 'BytesType'
+    _default_field = ByteField(mandatory=False)
+
+class FanoutProgress(object):
+    """Counts the rows of a fan-out that are done for sure: batches can finish
+       out of order, so only the unbroken run of finished batches counts."""
+    def __init__(self, done, callback=None):
+        self.lock = threading.Lock()
+        self.done = done
+        self.callback = callback
+        self.next_number = 0
+        self.pending = {}
+    
+    def finished(self, number, size):
+        with self.lock:
+            self.pending[number] = size
+            while self.next_number in self.pending:
+                self.done += self.pending.pop(self.next_number)
+                self.next_number += 1
+            done = self.done
+        if self.callback:
+            self.callback(done)
+
 class TimeOrderedIndex(Index):
+    """An Index that can split its rows into time buckets.
+
+       With _buckets set to 'day', 'week', 'month' (or a function from a UTC datetime
+       to a string that sorts by time), a column is stored in the row '<row_key>:<bucket>'
+       of its TimeUUID. Reads walk the buckets newest first and stop as soon as they
+       have enough columns, so reading recent items doesn't depend on the total history."""
     __abstract__ = True
     _order_by = 'TimeUUIDType'
+    _bucket_directory = None
+
+    @classmethod
+    def _init_class(cls, *args, **kwargs):
+        super(TimeOrderedIndex, cls)._init_class(*args, **kwargs)
+        if cls._buckets:
+            cls._init_bucket_directory()
+
+    @classmethod
+    def _init_bucket_directory(cls):
+        if not callable(cls._buckets):
+            assert cls._buckets in bucket_formats, 'Unknown bucket size %s' % (cls._buckets,)
+        class BucketDirectoryImplementation(BucketDirectory):
+            _column_family = '%s_Buckets' % (cls._column_family,)
+            _keyspace = cls._keyspace
+        setattr(BucketDirectoryImplementation, 'index_row_key', RowKey())
+        cls._bucket_directory = BucketDirectoryImplementation
+
+    @classmethod
+    def bucket_for_column_key(cls, column_key):
+        bucket_func = cls._buckets if callable(cls._buckets) else bucket_formats[cls._buckets]
+        return bucket_func(timestamp.importUUID(timestamp.uuidTime(column_key)))
+
+    @classmethod
+    def bucket_row_key(cls, row_key, bucket):
+        return '%s:%s' % (row_key, bucket)
+
+    def get_row_mutation_map(self, row_key, column_keys, clock=None):
+        if not self._buckets:
+            return super(TimeOrderedIndex, self).get_row_mutation_map(row_key, column_keys, clock=clock)
+        
+        buckets = OrderedDict()
+        for column_key in column_keys:
+            buckets.setdefault(self.bucket_for_column_key(column_key), []).append(column_key)
+        
+        directory = self._bucket_directory(row_key)
+        directory._update([(bucket, '') for bucket in buckets])
+        mumap = directory.get_mutation_map(row_key, clock=clock)
+        for bucket, bucket_column_keys in buckets.iteritems():
+            merge_mutation_maps(mumap, super(TimeOrderedIndex, self).get_row_mutation_map(
+                                    self.bucket_row_key(row_key, bucket), bucket_column_keys, clock=clock))
+        return mumap
+
+    @classmethod
+    def column_row_key(cls, row_key, column_key):
+        if not cls._buckets:
+            return super(TimeOrderedIndex, cls).column_row_key(row_key, column_key)
+        return cls.bucket_row_key(row_key, cls.bucket_for_column_key(column_key))
+
+    @classmethod
+    def get_rows_deletion_map(cls, row_keys, clock=None):
+        clock = clock or Clock(timestamp=cls._timestamp_func())
+        mumap = super(TimeOrderedIndex, cls).get_rows_deletion_map(row_keys, clock=clock)
+        if cls._buckets:
+            for row_key in row_keys:
+                for shard_row_key in cls.shard_row_keys(row_key):
+                    merge_mutation_maps(mumap, cls._bucket_directory.get_deletion_map(shard_row_key, clock=clock))
+        return mumap
+
+    @classmethod
+    def get_emptied_row_map(cls, shard_row_key, column_key, clock=None):
+        if not cls._buckets:
+            return super(TimeOrderedIndex, cls).get_emptied_row_map(shard_row_key, column_key, clock=clock)
+        return cls._bucket_directory.get_deletion_map(shard_row_key, [cls.bucket_for_column_key(column_key)],
+                                                      clock=clock)
+
+    @classmethod
+    def bucket_bounds(cls, start='', finish=''):
+        """The bucket directory slice bounds for the column key slice bounds start and finish."""
+        return dict(start=cls.bucket_for_column_key(start) if start else '',
+                    finish=cls.bucket_for_column_key(finish) if finish else '')
+
+    @classmethod
+    def iter_buckets(cls, row_key, reverse=True, page_size=100, start='', finish=''):
+        """Yields the buckets of row_key, optionally limited to the buckets that can
+           hold columns between the column keys start and finish."""
+        for bucket, _ in cls._bucket_directory.xget_slice(key=row_key, page_size=page_size, reverse=reverse,
+                                                           **cls.bucket_bounds(start, finish)):
+            yield bucket
+
+    @classmethod
+    def iter_rows(cls, row_keys, page_size=100, reverse=True, **kwargs):
+        if not cls._buckets or not row_keys:
+            return super(TimeOrderedIndex, cls).iter_rows(row_keys, page_size=page_size, reverse=reverse, **kwargs)
+        
+        # one multiget for the bucket lists, and one for the first page of each newest bucket
+        bounds = cls.bucket_bounds(kwargs.get('start', ''), kwargs.get('finish', ''))
+        buckets = cls._bucket_directory.xmultiget_slice(keys=list(row_keys), page_size=page_size, reverse=reverse, **bounds)
+        first_buckets = OrderedDict()
+        for row_key in row_keys:
+            for bucket, _ in buckets[row_key]:
+                first_buckets[row_key] = cls.bucket_row_key(row_key, bucket)
+                break
+        first_pages = super(TimeOrderedIndex, cls).iter_rows(first_buckets.values(), page_size=page_size,
+                                                             reverse=reverse, **kwargs)
+        first_pages = dict(zip(first_buckets.keys(), first_pages))
+        
+        rows = []
+        for row_key in row_keys:
+            if row_key not in first_buckets:
+                rows.append(iter([]))
+                continue
+            rest = (cls.xget_slice(key=cls.bucket_row_key(row_key, bucket), page_size=page_size, reverse=reverse, **kwargs)
+                        for bucket, _ in buckets[row_key])
+            rows.append(itertools.chain(first_pages[row_key], itertools.chain.from_iterable(rest)))
+        return rows
+
+    @classmethod
+    def merge(cls, row_keys, limit=50, page_size=None, reverse=True, **kwargs):
+        """Merges the rows row_keys of this Index into one timeline of (at most limit)
+           columns, newest first unless reverse=False, e.g. the tweets_sent of everybody
+           a user follows. Small pages of all rows are read with one multiget_slice and
+           more pages only from the rows the merge actually consumes. Returns an unsaved
+           instance of this Index without a row key, so .resolve() works as usual."""
+        page_size = page_size or min(limit, 20)
+        physical_row_keys = list(itertools.chain.from_iterable(cls.shard_row_keys(row_key) for row_key in row_keys))
+        merged = cls.iter_merged(physical_row_keys, page_size=page_size, reverse=reverse, **kwargs)
+        
+        timeline = cls()
+        timeline.row_key = None
+        timeline._update(itertools.islice(merged, limit), _for_loading=True)
+        return timeline
+
+    @classmethod
+    def physical_row_keys_multi(cls, row_keys, **kwargs):
+        shard_row_keys = super(TimeOrderedIndex, cls).physical_row_keys_multi(row_keys)
+        if not cls._buckets or not shard_row_keys:
+            return shard_row_keys
+        
+        # one multiget for the bucket directories of all shards
+        bounds = cls.bucket_bounds(kwargs.get('start', ''), kwargs.get('finish', ''))
+        all_shard_row_keys = list(set(itertools.chain.from_iterable(shard_row_keys.itervalues())))
+        buckets = cls._bucket_directory.xmultiget_slice(keys=all_shard_row_keys, reverse=kwargs.get('reverse', True),
+                                                         **bounds)
+        buckets = dict((shard_row_key, [bucket for bucket, _ in columns]) for shard_row_key, columns in buckets.iteritems())
+        return OrderedDict((row_key, [cls.bucket_row_key(shard_row_key, bucket) for shard_row_key in shards
+                                                                               for bucket in buckets[shard_row_key]])
+                               for row_key, shards in shard_row_keys.iteritems())
+
+    @classmethod
+    def iter_index_row_keys(cls, page_size=1000):
+        if not cls._buckets:
+            return super(TimeOrderedIndex, cls).iter_index_row_keys(page_size=page_size)
+        return cls._bucket_directory.iter_row_keys(page_size=page_size)
 
 class GeneratedIndex(TimeOrderedIndex):
-    __abstract__ = True
\ No newline at end of file
+    __abstract__ = True
+    _sweep_fieldname = None
+
+    @classmethod
+    def sweep(cls, page_size=500):
+        """Removes dangling entries: ones pointing to rows that no longer exist, and for
+           SecondaryIndexes ones whose target's field no longer has the value of the row
+           they are in. Checks page_size entries per multiget and removes them with one
+           batch_mutate per page. Returns the number of entries removed."""
+        foreign_class = cls._default_field.foreign_class
+        if cls._sweep_fieldname:
+            projection = dict(column_names=[cls._sweep_fieldname])
+        else:
+            projection = dict(count=1)
+        
+        removed = 0
+        for shard_row_key in cls.iter_index_row_keys(page_size=page_size):
+            row_key = cls.unshard_row_key(shard_row_key)
+            columns = cls.iter_row(shard_row_key, page_size=page_size)
+            while True:
+                page = list(itertools.islice(columns, page_size))
+                if not page:
+                    break
+                targets = foreign_class.load_multi(keys=list(set(target for column_key, target in page)),
+                                                   ordered=False, **projection)
+                targets = dict((target.row_key, target) for target in targets)
+                mumap = {}
+                for column_key, target in page:
+                    instance = targets.get(target)
+                    if instance is None or not instance.column_values:
+                        dangling = True
+                    elif cls._sweep_fieldname:
+                        dangling = instance.column_values.get(cls._sweep_fieldname) != row_key
+                    else:
+                        dangling = False
+                    if dangling:
+                        merge_mutation_maps(mumap, cls.get_removal_mutation_map(row_key, target, column_key=column_key))
+                        removed += 1
+                if mumap:
+                    cls.getclient().batch_mutate(mutation_map=mumap, consistency_level=cls._wcl(None))
+        return removed
+
+class IndexSweeper(threading.Thread):
+    """Runs sweep() on the generated indexes of some Models in the background, every interval seconds."""
+    def __init__(self, models, interval=3600, page_size=500):
+        threading.Thread.__init__(self, name='IndexSweeper')
+        self.daemon = True
+        self.indexes = [index for model in models for index in model.__dict__.values()
+                            if isinstance(index, type) and issubclass(index, GeneratedIndex)]
+        self.interval = interval
+        self.page_size = page_size
+        self.finished = threading.Event()
+        self.removed = 0
+    
+    def run(self):
+        while not self.finished.is_set():
+            for index in self.indexes:
+                try:
+                    self.removed += index.sweep(page_size=self.page_size)
+                except Exception:
+                    unhandled_exception_handler()
+            self.finished.wait(self.interval)
+    
+    def stop(self):
+        self.finished.set()
\ No newline at end of file
@@ -1,15 +1,19 @@
 import functools
 import itertools
+import Queue
+import threading
 import uuid
 from cassandra.ttypes import (Column, Clock, ColumnOrSuperColumn, ColumnParent,
     ColumnPath, ConsistencyLevel, NotFoundException, SlicePredicate,
-    SliceRange, SuperColumn, CfDef, Mutation)
+    SliceRange, SuperColumn, CfDef, Mutation, KeyRange, Deletion)
 
 from .datastructures import (OrderedSet,
                              OrderedDict,
                             )
 from .util import (gm_timestamp, 
                    CASPATHSEP,
+                   merge_mutation_maps,
+                   read_ahead,
                   )
 from .hierarchy import (InventoryType,
                         cmcache,
@@ -24,6 +28,16 @@ from .columns import (ConvertAPI,
 
 from .exceptions import TragedyException
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAX_COUNT = 2147483647 # largest slice count thrift will take
+
+# in Super ColumnFamilies, plain fields (e.g. created_at) are super columns with just this sub-column
+SCALAR_SUBCOLUMN = '\x00'
+
 known_sort_orders = ('BytesType', 'AsciiType', 'UTF8Type', 'LongType', 'LexicalUUIDType', 'TimeUUIDType')
 
 class RowKey(ConvertAPI):
@@ -56,6 +70,9 @@ class RowDefaults(object):
     _beensaved = False
     _beenloaded = False
     
+    # Seconds until Cassandra expires our columns, unless their field says otherwise.
+    _default_ttl = None
+    
     # If our class configuration is incomplete, fill in defaults
     _column_type = 'Standard'
     _order_by = 'BytesType'
@@ -75,6 +92,7 @@ class RowDefaults(object):
         assert keyspaces, 'No Keyspaces defined - make sure you define one before defining modules.'
         cls._keyspace = getattr(cls, '_keyspace', keyspaces[0])
         cls.save_hooks = OrderedSet()
+        cls.mutation_hooks = OrderedSet() # hook(instance, clock) -> mutation_map to write along with a save
         cls._keyspace.register_model(getattr(cls, '_column_family', name), cls)
     
     @classmethod
@@ -125,6 +143,12 @@ class BasicRow(RowDefaults):
         self.column_values    = {}  #
         self.column_changed  = {}  # these have no order themselves, but the keys are the same as above
         self.column_spec     = {}  #
+        self.column_resolved = {}  # external values kept by get(), and ForeignKeys from prefetch_related
+        self.column_previous = {}  # loaded or saved values of changed columns, to clean up indexes
+        self.column_deleted  = {}  # columns to delete on the next save, with their last known value
+        self.column_ttl      = {}  # ttls of single columns that override the field's, see Index.append
+        self.subcolumn_changed = {} # super column key -> changed sub-column keys, see set_subcolumn
+        self.subcolumn_deleted = {} # super column key -> sub-column keys to delete on the next save
         
         self.mirrors = OrderedSet()
                 
@@ -135,10 +159,13 @@ class BasicRow(RowDefaults):
         self._row_key_spec = None
         
         # Extract the Columnspecs
+        if '_converters' not in self.__class__.__dict__:
+            self._init_converters()
         self.extract_specs_from_class()
         
         if kwargs.get('_for_loading'):
             self._update(*args, **kwargs)
+            self._beenloaded = bool(self.column_values) # a missing row is still new
         else:
             self.update(*args, **kwargs)
             
@@ -164,6 +191,14 @@ class BasicRow(RowDefaults):
         
         if not self._row_key_name:
             raise TragedyException('need a name for the row key!')
+        
+        # Fields of our own, e.g. set by a subclass' __init__, need converter tables of our own
+        instance_specs = dict((attr, elem) for attr, elem in self.__dict__.iteritems()
+                                  if attr[0] != '_' and isinstance(elem, Field))
+        if instance_specs:
+            specs = dict(self._field_specs)
+            specs.update(instance_specs)
+            self._build_converters(self, specs)
 
 # ----- Access and convert data -----
     def __eq__(self, other):
@@ -171,12 +206,41 @@ class BasicRow(RowDefaults):
             return not self.row_key
         return self.row_key == other.row_key
     
+    @classmethod
+    def _init_converters(cls):
+        """Looks up the specs of all our Fields (inherited ones included) and their bound
+           converters once per class, so the hot loops don't getattr them per column. Each
+           converter table maps field names to converters and None to _default_field's."""
+        specs = {}
+        for attr in dir(cls):
+            if attr[0] != '_':
+                spec = getattr(cls, attr, None)
+                if isinstance(spec, Field):
+                    specs[attr] = spec
+        cls._build_converters(cls, specs)
+
+    @staticmethod
+    def _build_converters(target, specs):
+        """Sets the converter tables for the field specs on target, a class or an instance."""
+        def table(kind):
+            converters = dict((column_key, getattr(spec, kind)) for column_key, spec in specs.iteritems())
+            converters[None] = getattr(target._default_field, kind)
+            return converters
+        
+        target._field_specs = specs
+        target._converters = dict((access_mode, (table(access_mode), table('key_' + access_mode), table('value_' + access_mode)))
+                                     for access_mode in ('to_internal', 'to_external', 'to_identity', 'to_display'))
+        target._saving_converters = table('value_for_saving')
+        target._cache_external = set(column_key for column_key, spec in specs.iteritems() if spec.cache_external)
+
     def get_spec_for_columnkey(self, column_key):
         spec = self.column_spec.get(column_key)
         if not spec:
-            spec = getattr(self, column_key, None)
+            spec = self._field_specs.get(column_key)
         if not spec:
-            spec = self._default_field
+            spec = self.__dict__.get(column_key) # a Field set on us after __init__
+            if not isinstance(spec, ConvertAPI):
+                spec = self._default_field
         return spec
     
     def get_value_for_columnkey(self, column_key):
@@ -184,10 +248,26 @@ class BasicRow(RowDefaults):
             return self.row_key
         return self.column_values.get(column_key)
 
+    def get_ttl_for_columnkey(self, column_key):
+        ttl = self.column_ttl.get(column_key)
+        if ttl is None:
+            ttl = self.get_spec_for_columnkey(column_key).ttl
+        if ttl is None:
+            ttl = self._default_ttl
+        return ttl or None # a ttl of 0 keeps a field from expiring along with the rest
+
     def set_value_for_columnkey(self, column_key, value, dont_mark=False):
         assert isinstance(column_key, basestring), "Column Key needs to be a string."
+        if dont_mark:
+            self.column_previous.pop(column_key, None)
+        elif column_key in self.column_values and column_key not in self.column_changed:
+            self.column_previous[column_key] = self.column_values[column_key]
         self.ordered_columnkeys.add(column_key)
         self.column_values[column_key] = value
+        self.column_resolved.pop(column_key, None)
+        self.column_deleted.pop(column_key, None)
+        self.subcolumn_changed.pop(column_key, None) # the whole super column is written
+        self.subcolumn_deleted.pop(column_key, None)
         
         if dont_mark:
             self.unmarkChanged(column_key)
@@ -217,6 +297,7 @@ class BasicRow(RowDefaults):
     
     def yield_column_key_value_pairs(self, for_saving=False, **kwargs):
         access_mode = kwargs.pop('access_mode', 'to_identity')
+        column_keys = kwargs.pop('column_keys', None) or self.ordered_columnkeys
         
         missing_cols = self.listMissingColumns(for_saving=for_saving)
         if for_saving and missing_cols:
@@ -224,21 +305,23 @@ class BasicRow(RowDefaults):
                         ([(ck,self.column_spec[ck]) for ck in missing_cols],))
 
 
-        for column_key in self.ordered_columnkeys:
+        convert, convert_key, _ = self._converters[access_mode]
+        for_saving_converters = self._saving_converters
+        default_convert, default_convert_key, default_for_saving = convert[None], convert_key[None], for_saving_converters[None]
+        for column_key in column_keys:
             if for_saving:
                 if not (column_key in self.column_changed): # XXX: there are faster ways - profile?
                     continue
             assert isinstance(column_key, basestring), 'Column Key not of type string?'
-            spec = self.get_spec_for_columnkey(column_key)            
             value = self.get_value_for_columnkey(column_key)
             
             if for_saving:
-                value = spec.value_for_saving(value)
+                value = for_saving_converters.get(column_key, default_for_saving)(value)
             
             if not (value is None):
-                column_key, value = getattr(spec, access_mode)(column_key, value)
+                column_key, value = convert.get(column_key, default_convert)(column_key, value)
             else:
-                column_key = getattr(spec, 'key_' + access_mode)(column_key)
+                column_key = convert_key.get(column_key, default_convert_key)(column_key)
                 
             # if value is None:
             #     continue
@@ -254,6 +337,17 @@ class BasicRow(RowDefaults):
     def values(self):
         return [self.column_values[x] for x in self.ordered_columnkeys]
 
+    def iter_columns(self, page_size=1000, access_mode='to_external', **kwargs):
+        """Pages through all columns of this row in Cassandra, page_size at a time, and converts
+           them on the fly instead of loading them into the row, so memory use doesn't depend on
+           the width of the row. kwargs take slice bounds like start, finish and reverse."""
+        assert self.row_key, 'No row_key set!'
+        return self._convert_columns(self.xget_slice(key=self.row_key, page_size=page_size, **kwargs), access_mode)
+
+    def _convert_columns(self, columns, access_mode):
+        for column_key, value in columns:
+            yield getattr(self.get_spec_for_columnkey(column_key), access_mode)(column_key, value)
+
     def iterkeys(self):
         return ( (x, self.column_values[x]) for x in self.ordered_columnkeys)
     
@@ -274,14 +368,19 @@ class BasicRow(RowDefaults):
         tmp = OrderedDict()
         tmp.update(*args, **kwargs)
         
+        convert = self._converters[access_mode][0]
+        default_convert = convert[None]
         for column_key, value in tmp.iteritems():
             if column_key == self._row_key_name:
                 self.row_key = self._row_key_spec.value_to_internal(value)
                 continue
-            spec = self.column_spec.get(column_key, self._default_field)
-            column_key, value = getattr(spec, access_mode)(column_key, value)
+            column_key, value = convert.get(column_key, default_convert)(column_key, value)
             self.set_value_for_columnkey(column_key, value, dont_mark=_for_loading)
 
+    def is_new(self):
+        """True until we have been loaded or saved."""
+        return not (self._beensaved or self._beenloaded)
+
     def markChanged(self, column_key):
         self.column_changed[column_key] = True
 
@@ -290,18 +389,87 @@ class BasicRow(RowDefaults):
             del self.column_changed[column_key]
 
     def delete(self, column_key):
-        # XXX: keep track of delete
-        # XXX: can't delete if default columnspec is 'mandatory'.
-        spec = self.get_spec_for_columnkey(column_key)
-        if spec.mandatory:
+        """Removes column_key from this row. Cassandra forgets it on the next save()."""
+        if column_key in self.column_spec and self.column_spec[column_key].mandatory:
             raise TragedyException('Trying to delete mandatory column %s' % (column_key,))
-        del self.column_value[column_key]
+        self.column_deleted[column_key] = self.column_values.pop(column_key, None)
+        self.ordered_columnkeys.discard(column_key)
+        self.column_resolved.pop(column_key, None)
+        self.column_previous.pop(column_key, None)
+        self.column_ttl.pop(column_key, None)
+        self.subcolumn_changed.pop(column_key, None)
+        self.subcolumn_deleted.pop(column_key, None)
+        self.unmarkChanged(column_key)
+
+    def set_subcolumn(self, super_column_key, column_key, value):
+        """Sets one sub-column of a super column. Unless the whole super column was set,
+           save() only writes the sub-columns that changed, so the rest needn't be loaded."""
+        assert self._column_type == 'Super', '%s is not a Super ColumnFamily.' % (self._column_family,)
+        spec = self.get_spec_for_columnkey(super_column_key)
+        value = getattr(spec, 'subfield', spec).value_to_internal(value)
+        subcolumns = self.column_values.get(super_column_key)
+        if subcolumns is None:
+            subcolumns = self.column_values[super_column_key] = {}
+            self.ordered_columnkeys.add(super_column_key)
+        subcolumns[column_key] = value
+        self.column_deleted.pop(super_column_key, None)
+        self.subcolumn_deleted.get(super_column_key, set()).discard(column_key)
+        if super_column_key in self.subcolumn_changed or super_column_key not in self.column_changed:
+            self.subcolumn_changed.setdefault(super_column_key, set()).add(column_key)
+            self.markChanged(super_column_key)
+
+    def delete_subcolumn(self, super_column_key, column_key):
+        """Removes one sub-column of a super column. Cassandra forgets it on the next save()."""
+        assert self._column_type == 'Super', '%s is not a Super ColumnFamily.' % (self._column_family,)
+        self.column_values.get(super_column_key, {}).pop(column_key, None)
+        self.subcolumn_changed.get(super_column_key, set()).discard(column_key)
+        self.subcolumn_deleted.setdefault(super_column_key, set()).add(column_key)
+
+    def load_subcolumns(self, super_column_key, column_names=None, **kwargs):
+        """Loads (only the column_names or a slice of) the sub-columns of one super column,
+           without reading the other super columns of this row."""
+        assert self.row_key, 'No row_key set!'
+        subcolumns = self.get_slice(key=self.row_key, super_column=super_column_key, column_names=column_names, **kwargs)
+        self.column_values.setdefault(super_column_key, {}).update(subcolumns)
+        self.ordered_columnkeys.add(super_column_key)
+        return self
+
+    def iter_subcolumns(self, super_column_key, page_size=1000, **kwargs):
+        """Pages through the sub-columns of one super column, page_size at a time."""
+        assert self.row_key, 'No row_key set!'
+        return self.xget_slice(key=self.row_key, super_column=super_column_key, page_size=page_size, **kwargs)
+
+    def delete_row(self, write_consistency_level=None):
+        """Deletes this whole row (and its mirrors) right away, with one batch_mutate."""
+        assert self.row_key, 'No row_key set!'
+        row_keys = [row_key() if callable(row_key) else row_key
+                        for row_key in itertools.chain((self.row_key,), self.mirrors)]
+        mumap = self.get_rows_deletion_map(row_keys, clock=Clock(timestamp=self._timestamp_func()))
+        self.getclient().batch_mutate(mutation_map=mumap, consistency_level=self._wcl(write_consistency_level))
+        
+        self.ordered_columnkeys = OrderedSet()
+        for columns in (self.column_values, self.column_changed, self.column_resolved, self.column_previous,
+                        self.column_deleted, self.column_ttl, self.subcolumn_changed, self.subcolumn_deleted):
+            columns.clear()
+        return self
+
+    @classmethod
+    def delete_many(cls, keys, write_consistency_level=None):
+        """Deletes the rows keys with one batch_mutate, without loading them.
+           Returns the number of rows deleted."""
+        keys = list(OrderedSet(keys))
+        for row_key in keys:
+            assert row_key, 'Empty row_key %s' % (row_key,)
+        mumap = cls.get_rows_deletion_map(keys, clock=Clock(timestamp=cls._timestamp_func()))
+        if mumap:
+            cls.getclient().batch_mutate(mutation_map=mumap, consistency_level=cls._wcl(write_consistency_level))
+        return len(keys)
 
 # ----- Load Data -----
 
     @classmethod
-    def column_parent(cls):
-        return ColumnParent(column_family=cls._column_family, super_column=None)
+    def column_parent(cls, super_column=None):
+        return ColumnParent(column_family=cls._column_family, super_column=super_column)
     
     @property
     def query_defaults(self):
@@ -313,7 +481,7 @@ class BasicRow(RowDefaults):
     @staticmethod
     def get_slice_predicate(column_names=None, start='', finish='', reverse=True, count=10000, *args, **kwargs):
         if column_names:
-            return SlicePredicate(column_names=columns)
+            return SlicePredicate(column_names=column_names)
             
         slice_range = SliceRange(start=start, finish=finish, reversed=reverse, count=count)
         return SlicePredicate(slice_range=slice_range)
@@ -322,9 +490,12 @@ class BasicRow(RowDefaults):
     def decodeColumn(colOrSuper):
         # print 'DECODE', colOrSuper.column.name, colOrSuper.column.clock
         if colOrSuper.super_column:
+            columns = colOrSuper.super_column.columns
+            if len(columns) == 1 and columns[0].name == SCALAR_SUBCOLUMN:
+                return colOrSuper.super_column.name, columns[0].value
             # translate superColumn to dict
             values = {}
-            for i in colOrSuper.super_column.columns:
+            for i in columns:
                  values[i.name] = i.value
             return colOrSuper.super_column.name, values
         else:
@@ -332,6 +503,12 @@ class BasicRow(RowDefaults):
         
     @classmethod
     def load_multi(cls, ordered=True, *args, **kwargs):
+        chunk_size = kwargs.pop('chunk_size', None)
+        if chunk_size:
+            for row in cls._load_chunked(chunk_size, ordered=ordered, *args, **kwargs):
+                yield row
+            raise StopIteration
+        
         unordered = {}
         if not kwargs['keys']:
             raise StopIteration
@@ -341,29 +518,67 @@ class BasicRow(RowDefaults):
             assert isinstance(row_key, basestring), 'Row Key %s is of type %s should be basestring.' % (row_key, type(row_key,))
         
         for row_key, columns in cls.multiget_slice(*args, **kwargs):
-            columns = OrderedDict(columns)
-            columns['row_key'] = row_key
-            columns['access_mode'] = 'to_identity'
-            columns['_for_loading'] = True
             if not ordered:
-                yield cls( **columns)
+                yield cls._from_columns(row_key, columns)
             else:
                 unordered[row_key] = columns
         
         if not ordered:
             raise StopIteration
-            
-        for row_key in kwargs['keys']:
-            blah = unordered.get(row_key)
-            yield cls( **blah )
+        
+        rows = [cls._from_columns(row_key, unordered.get(row_key, [])) for row_key in kwargs['keys']]
+        for row in cls.convert_in_bulk(rows):
+            yield row
+
+    @classmethod
+    def convert_in_bulk(cls, rows):
+        """Converts the columns of rows whose fields have a fast values_to_external (like
+           TimeFields) for all rows at once, and keeps the results for get()."""
+        if not rows:
+            return rows
+        for column_key, spec in rows[0].column_spec.iteritems():
+            if not (spec.bulk_external and spec.cache_external):
+                continue
+            loaded = [row for row in rows if row.column_values.get(column_key) is not None]
+            values = spec.values_to_external([row.column_values[column_key] for row in loaded])
+            for row, value in itertools.izip(loaded, values):
+                row.column_resolved[column_key] = value
+        return rows
+
+    @classmethod
+    def _load_chunked(cls, chunk_size, ordered=True, pipeline=2, *args, **kwargs):
+        """load_multi(keys=..., chunk_size=N): keys can be any iterable and are read with one
+           multiget_slice per N keys. With a thread-local connection up to pipeline chunks are
+           read ahead in the background, so only about (pipeline + 1) * N rows are in memory."""
+        keys = iter(kwargs.pop('keys'))
+        chunks = iter(lambda: list(itertools.islice(keys, chunk_size)), [])
+        def fetch(chunk):
+            for row_key in chunk:
+                assert row_key, 'Empty row_key %s' % (row_key,)
+                assert isinstance(row_key, basestring), 'Row Key %s is of type %s should be basestring.' % (row_key, type(row_key,))
+            return chunk, list(cls.multiget_slice(keys=chunk, *args, **kwargs))
+        
+        fetched = itertools.imap(fetch, chunks)
+        if pipeline and cls.getclient().thread_safe:
+            fetched = read_ahead(fetched, depth=pipeline)
+        
+        for chunk, rows in fetched:
+            if ordered:
+                rows = dict(rows)
+                rows = [(row_key, rows.get(row_key, [])) for row_key in chunk]
+            for row in cls.convert_in_bulk([cls._from_columns(row_key, columns) for row_key, columns in rows]):
+                yield row
     
     def load(self, *args, **kwargs):
         if not self.row_key and self._row_key_spec.default:
                 self.row_key = self._row_key_spec.get_default()
         assert self.row_key, 'No row_key and no non-null non-empty keys argument. Did you use the right row_key_name?'
         tkeys = [self.row_key]
-        result = list(self.load_multi(keys=tkeys))
-        self._update(result[0].column_values, _for_loading=True)
+        # not load_multi: converting in bulk doesn't pay off for a single row
+        columns = dict(self.multiget_slice(keys=tkeys)).get(self.row_key, [])
+        self._update(columns, _for_loading=True)
+        if columns: # a missing row is still new
+            self._beenloaded = True
         return self
         # # print self, dir(self), self._row_key_name
         # assert self.row_key, 'No row_key and no non-null non-empty keys argument. Did you use the right row_key_name?'
@@ -381,14 +596,14 @@ class BasicRow(RowDefaults):
         # return self
         
     @classmethod
-    def multiget_slice(cls, keys=None, consistency_level=None, **kwargs):
+    def multiget_slice(cls, keys=None, consistency_level=None, super_column=None, **kwargs):
         assert keys, 'Need a non-null non-empty keys argument.'
         # print 'GETTING', cls, keys, kwargs
         
         predicate = cls.get_slice_predicate(**kwargs)
         key_slices = cls.getclient().multiget_slice(    #  keyspace          = str(cls._keyspace),
                                                       keys              = keys,
-                                                      column_parent     = cls.column_parent(),
+                                                      column_parent     = cls.column_parent(super_column),
                                                       predicate         = predicate,
                                                       consistency_level=cls._rcl(consistency_level),
                                                      )
@@ -399,11 +614,253 @@ class BasicRow(RowDefaults):
         #                         colOrSuper in result[1]]
         #     yield key, value
 
+    @classmethod
+    def get_slice(cls, key=None, consistency_level=None, super_column=None, **kwargs):
+        assert key, 'Need a non-null non-empty key argument.'
+        
+        predicate = cls.get_slice_predicate(**kwargs)
+        columns = cls.getclient().get_slice(key               = key,
+                                            column_parent     = cls.column_parent(super_column),
+                                            predicate         = predicate,
+                                            consistency_level = cls._rcl(consistency_level),
+                                           )
+        return [cls.decodeColumn(col) for col in columns]
+
+    @classmethod
+    def get_count(cls, key=None, consistency_level=None, count=MAX_COUNT, super_column=None, **kwargs):
+        """Number of columns in the slice of row key, counted by Cassandra."""
+        assert key, 'Need a non-null non-empty key argument.'
+        predicate = cls.get_slice_predicate(count=count, **kwargs)
+        return cls.getclient().get_count(key               = key,
+                                         column_parent     = cls.column_parent(super_column),
+                                         predicate         = predicate,
+                                         consistency_level = cls._rcl(consistency_level),
+                                        )
+
+    @classmethod
+    def multiget_count(cls, keys=None, consistency_level=None, count=MAX_COUNT, super_column=None, **kwargs):
+        """Like get_count for many rows at once. Returns a dict of row key to count."""
+        assert keys, 'Need a non-null non-empty keys argument.'
+        predicate = cls.get_slice_predicate(count=count, **kwargs)
+        return cls.getclient().multiget_count(keyspace          = str(cls._keyspace),
+                                              keys              = keys,
+                                              column_parent     = cls.column_parent(super_column),
+                                              predicate         = predicate,
+                                              consistency_level = cls._rcl(consistency_level),
+                                             )
+
+    @classmethod
+    def xget_slice(cls, key=None, page_size=1000, start='', **kwargs):
+        """Like get_slice, but pages through the whole row page_size columns at a time."""
+        skip = None
+        while True:
+            columns = cls.get_slice(key=key, start=start, count=page_size + (1 if skip else 0), **kwargs)
+            if skip and columns and columns[0][0] == skip:
+                columns = columns[1:] # slice starts are inclusive
+            for column in columns:
+                yield column
+            if len(columns) < page_size:
+                return
+            start = skip = columns[-1][0]
+
+    @classmethod
+    def xmultiget_slice(cls, keys=None, page_size=1000, **kwargs):
+        """Like xget_slice for many rows: returns a dict of row key to an iterator over the
+           columns of that row. The first page of every row comes from one multiget_slice,
+           further pages are only read for rows whose iterators get that far."""
+        first_pages = dict(cls.multiget_slice(keys=keys, count=page_size, **kwargs))
+        return dict((key, cls._continue_slice(key, first_pages.get(key, []), page_size, **kwargs)) for key in keys)
+
+    @classmethod
+    def _continue_slice(cls, key, first_page, page_size, **kwargs):
+        for column in first_page:
+            yield column
+        if len(first_page) < page_size:
+            return
+        kwargs['start'] = last = first_page[-1][0]
+        for column in cls.xget_slice(key=key, page_size=page_size, **kwargs):
+            if column[0] != last:
+                yield column
+
+    @classmethod
+    def iter_row_keys(cls, page_size=1000, consistency_level=None):
+        """Yields the keys of all rows in our ColumnFamily, in partitioner order."""
+        predicate = cls.get_slice_predicate(count=1)
+        start_key = skip = ''
+        while True:
+            key_range = KeyRange(start_key=start_key, end_key='', count=page_size + (1 if skip else 0))
+            key_slices = cls.getclient().get_range_slices(column_parent     = cls.column_parent(),
+                                                          predicate         = predicate,
+                                                          range             = key_range,
+                                                          consistency_level = cls._rcl(consistency_level),
+                                                         )
+            if skip and key_slices and key_slices[0].key == skip:
+                key_slices = key_slices[1:] # key ranges are start-inclusive
+            for key_slice in key_slices:
+                if key_slice.columns: # skip range ghosts of deleted rows
+                    yield key_slice.key
+            if len(key_slices) < page_size:
+                return
+            start_key = skip = key_slices[-1].key
+
+    @classmethod
+    def iter_token_splits(cls, keys_per_split=65536):
+        """Splits the token ring into (start_token, end_token) ranges of roughly keys_per_split
+           rows of our ColumnFamily each, using describe_ring and describe_splits."""
+        client = cls.getclient()
+        for token_range in client.describe_ring(str(cls._keyspace)):
+            tokens = client.describe_splits(str(cls._keyspace), cls._column_family,
+                                            token_range.start_token, token_range.end_token, keys_per_split)
+            for split in zip(tokens, tokens[1:]):
+                yield split
+
+    @classmethod
+    def iter_range_pages(cls, start_token, end_token, page_size=100, consistency_level=None, **kwargs):
+        """Pages through the rows whose tokens lie in (start_token, end_token], yielding lists of
+           (row_key, columns). kwargs limit the columns read per row like for multiget_slice."""
+        predicate = cls.get_slice_predicate(**kwargs)
+        while True:
+            key_range = KeyRange(start_token=start_token, end_token=end_token, count=page_size)
+            key_slices = cls.getclient().get_range_slices(column_parent     = cls.column_parent(),
+                                                          predicate         = predicate,
+                                                          range             = key_range,
+                                                          consistency_level = cls._rcl(consistency_level),
+                                                         )
+            # skip range ghosts of deleted rows
+            yield [(key_slice.key, [cls.decodeColumn(col) for col in key_slice.columns])
+                        for key_slice in key_slices if key_slice.columns]
+            if len(key_slices) < page_size:
+                return
+            # token ranges are start-exclusive, so we continue right after the last row
+            start_token = cls._keyspace.cluster.token(key_slices[-1].key)
+
+    @classmethod
+    def scan(cls, workers=8, page_size=100, keys_per_split=65536, **kwargs):
+        """Yields every row of our ColumnFamily as a loaded instance, in no particular order.
+           The token ring is cut into splits that up to workers threads page through in
+           parallel (one at a time without a thread-local connection), reading at most a
+           few pages ahead of the consumer. kwargs limit the columns read per row."""
+        for page in cls.iter_scan_pages(workers=workers, page_size=page_size, keys_per_split=keys_per_split, **kwargs):
+            for row_key, columns in page:
+                yield cls._from_columns(row_key, columns)
+
+    @classmethod
+    def iter_scan_pages(cls, workers=8, page_size=100, keys_per_split=65536, **kwargs):
+        """scan, but yields the pages of (row_key, columns) as they are read."""
+        splits = list(cls.iter_token_splits(keys_per_split=keys_per_split))
+        read = functools.partial(cls.iter_range_pages, page_size=page_size, **kwargs)
+        if not cls.getclient().thread_safe:
+            workers = 1
+        workers = min(workers, len(splits))
+        
+        if workers <= 1:
+            for start_token, end_token in splits:
+                for page in read(start_token, end_token):
+                    yield page
+            return
+        
+        pending = Queue.Queue()
+        for split in splits:
+            pending.put(split)
+        pages = Queue.Queue(maxsize=workers * 2) # bounds how far the workers read ahead of us
+        stopped = threading.Event()
+        def worker():
+            try:
+                while not stopped.is_set():
+                    try:
+                        start_token, end_token = pending.get_nowait()
+                    except Queue.Empty:
+                        return
+                    for page in read(start_token, end_token):
+                        if stopped.is_set():
+                            return
+                        pages.put((page, None))
+            except Exception, e:
+                pages.put((None, e))
+            finally:
+                pages.put((None, None))
+        
+        threads = [threading.Thread(target=worker) for i in xrange(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            running = workers
+            while running:
+                page, error = pages.get()
+                if error is not None:
+                    raise error
+                if page is None:
+                    running -= 1
+                    continue
+                yield page
+        finally:
+            # on errors or when our consumer stops early, unblock and end the workers
+            stopped.set()
+            while any(thread.is_alive() for thread in threads):
+                try:
+                    pages.get(timeout=0.1)
+                except Queue.Empty:
+                    pass
+
+    @classmethod
+    def load_columnar(cls, keys, fields, chunk_size=1000, consistency_level=None):
+        """Loads only fields of the rows keys, as a ColumnarResult instead of row instances.
+           Rows are read chunk_size at a time; missing values are None."""
+        keys = list(keys)
+        def rows():
+            for start in xrange(0, len(keys), chunk_size):
+                chunk = keys[start:start + chunk_size]
+                loaded = dict(cls.multiget_slice(keys=chunk, column_names=list(fields), consistency_level=consistency_level))
+                for row_key in chunk:
+                    yield row_key, loaded.get(row_key, [])
+        return cls.to_columnar(fields, rows())
+
+    @classmethod
+    def scan_columnar(cls, fields, batch_size=10000, **kwargs):
+        """Like scan, but reads only fields and yields ColumnarResults of up to batch_size
+           rows. Rows that have none of fields are skipped."""
+        pages = cls.iter_scan_pages(column_names=list(fields), **kwargs)
+        rows = itertools.chain.from_iterable(pages)
+        while True:
+            batch = cls.to_columnar(fields, itertools.islice(rows, batch_size))
+            if not batch['row_key']:
+                return
+            yield batch
+
+    @classmethod
+    def to_columnar(cls, fields, rows):
+        """Turns (row_key, columns) pairs, as multiget_slice yields them, into a ColumnarResult."""
+        row_keys = []
+        stored = OrderedDict((field, []) for field in fields)
+        for row_key, columns in rows:
+            row_keys.append(row_key)
+            columns = dict(columns)
+            for field, values in stored.iteritems():
+                values.append(columns.get(field))
+        
+        result = ColumnarResult()
+        result['row_key'] = row_keys
+        for field, values in stored.iteritems():
+            spec = getattr(cls, field, None)
+            if not isinstance(spec, ConvertAPI):
+                spec = cls._default_field
+            result[field] = _convert_column(spec, values)
+        return result
+
+    @classmethod
+    def _from_columns(cls, row_key, columns):
+        # columns as a list, because keyword arguments would lose their order
+        return cls(row_key, columns, access_mode='to_identity', _for_loading=True)
+
 # ----- Save Data -----
     def generate_row_key(self):
         self.row_key = uuid.uuid4().hex
 
     def save(self, *args, **kwargs):
+        """Writes our changes. With async_=True the write happens in the background
+           (see Keyspace.configure_write_behind) and a WriteFuture is returned instead."""
+        async_ = kwargs.pop('async_', False)
         if not kwargs.get('write_consistency_level'):
             kwargs['write_consistency_level'] = None
         
@@ -415,42 +872,119 @@ class BasicRow(RowDefaults):
             else:
                 raise TragedyException('No row_key set!')
         
-        for save_row_key in itertools.chain((self.row_key,), self.mirrors):
-            if callable(save_row_key):
-                save_row_key = save_row_key()
-            self._real_save(save_row_key=save_row_key, *args, **kwargs)
+        future = self._real_save(async_=async_, *args, **kwargs)
         
+        # hooks can tell what this save changed from column_changed and is_new()
         for hook in self.save_hooks:
             hook(self)
         
+        # reset 'changed' - nothing's changed anymore
+        self.column_changed.clear()
+        self.column_previous.clear()
+        self.column_deleted.clear()
+        self.column_ttl.clear()
+        self.subcolumn_changed.clear()
+        self.subcolumn_deleted.clear()
         self._beensaved = True
         
+        if async_:
+            return future
         return self
         
-    def _real_save(self, save_row_key=None, *args, **kwargs):
+    @classmethod
+    def get_deletion_map(cls, row_key, column_keys=None, clock=None):
+        """Builds the batch_mutate mutation_map that deletes column_keys (or the whole row) from row_key.
+           Pass the same clock to deletions that belong together."""
+        predicate = SlicePredicate(column_names=list(column_keys)) if column_keys else None
+        deletion = Deletion(clock=clock or Clock(timestamp=cls._timestamp_func()), predicate=predicate)
+        return {row_key: {cls._column_family: [Mutation(deletion=deletion)]}}
+
+    @classmethod
+    def get_row_deletion_map(cls, row_key, clock=None):
+        """The mutation_map that deletes everything stored for our row row_key."""
+        return cls.get_rows_deletion_map([row_key], clock=clock)
+
+    @classmethod
+    def get_rows_deletion_map(cls, row_keys, clock=None):
+        """get_row_deletion_map for many rows at once, so subclasses that have to read
+           before they know what to delete can do so with one multiget."""
+        clock = clock or Clock(timestamp=cls._timestamp_func())
+        mumap = {}
+        for row_key in row_keys:
+            merge_mutation_maps(mumap, cls.get_deletion_map(row_key, clock=clock))
+        return mumap
+
+    def store_resolved_changes(self):
+        """Sets the columns whose kept external values (see get()) were changed in place,
+           like a dict from a JSONField, so saving doesn't lose those changes."""
+        for column_key, value in self.column_resolved.items():
+            spec = self.get_spec_for_columnkey(column_key)
+            if not spec.mutable_external or column_key not in self.column_values:
+                continue
+            if spec.value_to_external(self.column_values[column_key]) != value:
+                self.set_value_for_columnkey(column_key, spec.value_to_internal(value))
+                self.column_resolved[column_key] = value
+
+    def get_save_mutation_map(self, clock=None):
+        """Everything one save() writes: our row, our mirrors and what the mutation_hooks
+           add, all with the same clock so the copies can't disagree."""
+        self.store_resolved_changes()
+        clock = clock or Clock(timestamp=self._timestamp_func())
+        mumap = {}
+        for save_row_key in itertools.chain((self.row_key,), self.mirrors):
+            if callable(save_row_key):
+                save_row_key = save_row_key()
+            merge_mutation_maps(mumap, self.get_mutation_map(save_row_key, clock=clock))
+        for hook in self.mutation_hooks:
+            merge_mutation_maps(mumap, hook(self, clock) or {})
+        return mumap
+
+    def _real_save(self, async_=False, *args, **kwargs):
+        mumap = self.get_save_mutation_map()
+        # print u'MUMAP', repr(mumap).encode('ascii', 'replace')
+        if async_:
+            return self._keyspace.get_write_behind().submit(mumap, self._wcl(kwargs['write_consistency_level']))
+        if mumap:
+            self.getclient().batch_mutate(
+                                          mutation_map=mumap,
+                                          consistency_level=self._wcl(kwargs['write_consistency_level']),
+                                         )
+
+    def get_mutation_map(self, save_row_key, column_keys=None, clock=None):
+        """Builds the batch_mutate mutation_map that writes our changed columns
+           (or the changed ones among column_keys) to save_row_key, all with one clock."""
+        clock = clock or Clock(timestamp=self._timestamp_func())
         save_columns = []
-        for column_key, value in self.yield_column_key_value_pairs(for_saving=True):
-            col = {}
-            newtimestamp = self._timestamp_func()
-            import time
+        for column_key, value in self.yield_column_key_value_pairs(for_saving=True, column_keys=column_keys):
+            ttl = self.get_ttl_for_columnkey(column_key)
             if self._column_type == 'Standard':
                 assert isinstance(value, basestring), 'Not basestring %s:%s (%s)' % (column_key, type(value), type(self))
-                column = Column(name=column_key, value=value, clock=Clock(timestamp=newtimestamp))
-                save_columns.append( ColumnOrSuperColumn(column=column) )
+                column = Column(name=column_key, value=value, clock=clock, ttl=ttl)
                 save_columns.append(ColumnOrSuperColumn(column=column))
-            else:
-                # TODO, skips non dict items such as created_at
-                #assert isinstance(value, dict), 'Not dict %s:%s (%s)' % (column_key, type(value), type(self))
+            elif isinstance(value, dict):
                 # translate dict to superColumn
-                if isinstance(value, dict):
-                    cols = []
-                    for k, v in value.items():
-                        cols.append(Column(name=k, value=v, clock=Clock(timestamp=newtimestamp)))
-                    super_column = SuperColumn(name=column_key, columns=cols)
-                    save_columns.append(ColumnOrSuperColumn(super_column=super_column))
-            # print 'STORING WITH NEWTIMESTAMP', self.__class__, column_key, newtimestamp #time.ctime( int(newtimestamp) ) 
+                changed = self.subcolumn_changed.get(column_key) # None if the whole super column changed
+                cols = [Column(name=k, value=v, clock=clock, ttl=ttl) for k, v in value.iteritems()
+                            if changed is None or k in changed]
+                super_column = SuperColumn(name=column_key, columns=cols)
+                save_columns.append(ColumnOrSuperColumn(super_column=super_column))
+            else:
+                assert isinstance(value, basestring), 'Not basestring %s:%s (%s)' % (column_key, type(value), type(self))
+                cols = [Column(name=SCALAR_SUBCOLUMN, value=value, clock=clock, ttl=ttl)]
+                super_column = SuperColumn(name=column_key, columns=cols)
+                save_columns.append(ColumnOrSuperColumn(super_column=super_column))
+            # print 'STORING WITH CLOCK', self.__class__, column_key, clock.timestamp
         
         save_mutations = [Mutation(column_or_supercolumn=sc) for sc in save_columns]
+        if self.column_deleted and column_keys is None:
+            predicate = SlicePredicate(column_names=self.column_deleted.keys())
+            save_mutations.append(Mutation(deletion=Deletion(clock=clock, predicate=predicate)))
+        if self.subcolumn_deleted and column_keys is None:
+            for super_column_key, subcolumn_keys in self.subcolumn_deleted.iteritems():
+                if subcolumn_keys:
+                    predicate = SlicePredicate(column_names=list(subcolumn_keys))
+                    save_mutations.append(Mutation(deletion=Deletion(clock=clock, super_column=super_column_key,
+                                                                     predicate=predicate)))
         
         # self.getclient().batch_insert(#keyspace         = str(self._keyspace),
         #                          key              = save_row_key,
@@ -459,14 +993,7 @@ class BasicRow(RowDefaults):
         #                         )
         mumap = {save_row_key: {self._column_family: save_mutations} }
         # print u'PREMUMAP', unicode(save_mutations).encode('ascii', 'replace')
-        # print u'MUMAP', repr(mumap).encode('ascii', 'replace')
-        self.getclient().batch_mutate(
-                                      mutation_map=mumap,
-                                      consistency_level=self._wcl(kwargs['write_consistency_level']),
-                                     )
-        
-        # reset 'changed' - nothing's changed anymore
-        self.column_changed.clear()
+        return mumap
 
 # ----- Display -----
         
@@ -485,6 +1012,67 @@ class BasicRow(RowDefaults):
                 p+= u'%s%s' % (CASPATHSEP, repr(column_key),)
         return p
 
+class ColumnarResult(OrderedDict):
+    """Rows as columns: 'row_key' and each field name map to a list with one value per
+       row, or to a numpy array for fields with a numpy_dtype when numpy is installed."""
+    def to_records(self):
+        """A numpy record array with one record per row, for vectorized aggregation."""
+        if numpy is None:
+            raise TragedyException('to_records needs numpy.')
+        return numpy.rec.fromarrays([numpy.asarray(column) for column in self.itervalues()], names=list(self.keys()))
+
+def _convert_column(spec, values):
+    present = [value for value in values if value is not None]
+    if isinstance(spec, ForeignKey): # keep row keys, instances would defeat the purpose
+        return values
+    converted = spec.values_to_external(present)
+    if len(present) < len(values):
+        converted = iter(converted)
+        return [None if value is None else converted.next() for value in values]
+    if numpy is not None and spec.numpy_dtype:
+        return numpy.array(converted, dtype=spec.numpy_dtype)
+    return converted
+
+def prefetch_related(rows, paths):
+    """Loads the ForeignKeys named by paths (like 'author' or 'author.avatar') of rows
+       and wires the loaded instances into them, so row.get('author') doesn't need
+       another round-trip. Each level takes one load_multi per foreign class."""
+    tree = OrderedDict()
+    for path in paths:
+        node = tree
+        for column_key in path.split('.'):
+            node = node.setdefault(column_key, OrderedDict())
+    _prefetch_level(rows, tree)
+    return rows
+
+def _prefetch_level(rows, tree):
+    wanted = OrderedDict() # foreign_class -> row keys, deduplicated across all rows and columns
+    for column_key in tree:
+        for row in rows:
+            value = row.column_values.get(column_key)
+            if not value:
+                continue
+            spec = row.get_spec_for_columnkey(column_key)
+            if not isinstance(spec, ForeignKey):
+                raise TragedyException('Can only prefetch ForeignKeys, %s of %s is not.' % (column_key, row.__class__.__name__))
+            wanted.setdefault(spec.foreign_class, OrderedSet()).add(value)
+    
+    loaded = {}
+    for foreign_class, keys in wanted.iteritems():
+        for instance in foreign_class.load_multi(keys=list(keys), ordered=False):
+            loaded[(foreign_class, instance.row_key)] = instance
+    
+    for column_key, subtree in tree.iteritems():
+        children = OrderedDict()
+        for row in rows:
+            value = row.column_values.get(column_key)
+            instance = loaded.get((getattr(row.get_spec_for_columnkey(column_key), 'foreign_class', None), value))
+            if instance is not None:
+                row.column_resolved[column_key] = instance
+                children[id(instance)] = instance
+        if subtree and children:
+            _prefetch_level(children.values(), subtree)
+
 class DictRow(BasicRow):
     """Row with a public dictionary interface to set and get columns."""
     __abstract__ = True
@@ -502,10 +1090,16 @@ class DictRow(BasicRow):
     def get(self, column_key, default=None, **kwargs):
         access_mode = kwargs.pop('access_mode', 'to_external')
         
-        spec = self.get_spec_for_columnkey(column_key)
+        if access_mode == 'to_external' and column_key in self.column_resolved:
+            return self.column_resolved[column_key]
+        
         value = self.get_value_for_columnkey(column_key)
         if not (value is None):
-            value = getattr(spec, 'value_' + access_mode)(value)
+            convert = self._converters[access_mode][2]
+            value = convert.get(column_key, convert[None])(value)
+            if access_mode == 'to_external' and (column_key in self._cache_external or
+                                                 (column_key not in self._field_specs and self._default_field.cache_external)):
+                self.column_resolved[column_key] = value
         else:
             value = default
         return value
\ No newline at end of file
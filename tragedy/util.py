@@ -2,6 +2,7 @@ import sys
 import traceback
 import threading
 import time
+import Queue
 
 CASPATHSEP = ' -> '
     
@@ -14,6 +15,51 @@ def popmulti(d, *args):
 def warn(msg):
     print 'WARN:', msg
 
+def merge_mutation_maps(mumap, other):
+    """Adds the mutations of the batch_mutate mutation_map other to mumap."""
+    for row_key, cfmap in other.iteritems():
+        row = mumap.setdefault(row_key, {})
+        for column_family, mutations in cfmap.iteritems():
+            row.setdefault(column_family, []).extend(mutations)
+    return mumap
+
+def read_ahead(iterable, depth=1):
+    """Iterates over iterable in a background thread, at most depth items ahead of
+       the consumer, so slow producers (like network reads) overlap with consuming."""
+    items = Queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+    done = object()
+    def producer():
+        try:
+            for item in iterable:
+                if stopped.is_set():
+                    return
+                items.put((item, None))
+        except Exception, e:
+            items.put((done, e))
+        else:
+            items.put((done, None))
+    
+    thread = threading.Thread(target=producer)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        # when our consumer stops early, unblock and end the producer
+        stopped.set()
+        while thread.is_alive():
+            try:
+                items.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+
 def gm_timestamp():
     """int : UNIX epoch time in GMT"""
     return int(time.time() * 1e6)
@@ -55,6 +101,45 @@ class CrossModelCache(object):
             except:
                 pass
 
+class ExpiringCache(object):
+    """Thread-safe dict whose entries expire after a per-entry time to live in seconds.
+       Entries stored with a group can be dropped together with drop_group."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.storage = {}
+        self.groups = {}
+    
+    def store(self, key, value, ttl, group=None):
+        with self.lock:
+            self.storage[key] = (value, time.time() + ttl, group)
+            if group is not None:
+                self.groups.setdefault(group, set()).add(key)
+    
+    def retrieve(self, key, default=None):
+        with self.lock:
+            value, expires, group = self.storage.get(key, (default, None, None))
+            if expires is not None and expires < time.time():
+                self._forget(key)
+                return default
+            return value
+    
+    def drop(self, key):
+        with self.lock:
+            self._forget(key)
+    
+    def drop_group(self, group):
+        with self.lock:
+            for key in self.groups.pop(group, ()):
+                self.storage.pop(key, None)
+    
+    def _forget(self, key):
+        value, expires, group = self.storage.pop(key, (None, None, None))
+        keys = self.groups.get(group)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.groups[group]
+
 def unhandled_exception_handler(reraise=False):
     tb = sys.exc_info()[2]
     stack = []
@@ -0,0 +1,230 @@
+"""Asynchronous (write-behind) saves, for writes nobody has to wait for."""
+import threading
+import time
+
+from cassandra.ttypes import (ColumnOrSuperColumn, Mutation, SuperColumn)
+
+from .datastructures import (OrderedDict,)
+from .exceptions import TragedyException
+
+class WriteFuture(object):
+    """The outcome of an asynchronous write. result() waits until it is written
+       and raises what the write raised."""
+    def __init__(self, parts=1):
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._parts = parts # a save can touch many rows, each is written on its own
+        self._error = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done.is_set()
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TragedyException('Write not finished after %s seconds.' % (timeout,))
+        return self._error
+
+    def result(self, timeout=None):
+        error = self.exception(timeout)
+        if error is not None:
+            raise error
+        return None
+
+    def add_done_callback(self, callback):
+        """Calls callback(future) once we're written (or failed), right away if we are."""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _part_done(self, error=None):
+        with self._lock:
+            if error is not None and self._error is None:
+                self._error = error
+            self._parts -= 1
+            if self._parts > 0:
+                return
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                pass # a broken callback mustn't take the writer down with it
+
+class PendingRow(object):
+    """The mutations waiting to be written to one row of one column family. Of several
+       writes of the same column (or sub-column) only the one with the latest clock
+       is kept; deletions are kept as they are and left to Cassandra's clocks."""
+    def __init__(self):
+        self.columns = OrderedDict() # column name -> Column
+        self.super_columns = OrderedDict() # super column name -> OrderedDict of sub-column name -> Column
+        self.deletions = []
+        self.futures = []
+    
+    def add(self, mutations):
+        """Adds mutations and returns how many column writes they made redundant."""
+        coalesced = 0
+        for mutation in mutations:
+            if mutation.deletion:
+                self.deletions.append(mutation)
+            elif mutation.column_or_supercolumn.column:
+                coalesced += self._keep_latest(self.columns, mutation.column_or_supercolumn.column)
+            else:
+                super_column = mutation.column_or_supercolumn.super_column
+                subcolumns = self.super_columns.setdefault(super_column.name, OrderedDict())
+                for column in super_column.columns:
+                    coalesced += self._keep_latest(subcolumns, column)
+        return coalesced
+    
+    @staticmethod
+    def _keep_latest(columns, column):
+        existing = columns.get(column.name)
+        if existing is not None and existing.clock.timestamp > column.clock.timestamp:
+            return 1
+        columns[column.name] = column
+        return 0 if existing is None else 1
+    
+    def mutations(self):
+        mutations = [Mutation(column_or_supercolumn=ColumnOrSuperColumn(column=column))
+                         for column in self.columns.itervalues()]
+        mutations.extend(Mutation(column_or_supercolumn=ColumnOrSuperColumn(
+                                      super_column=SuperColumn(name=name, columns=subcolumns.values())))
+                             for name, subcolumns in self.super_columns.iteritems())
+        mutations.extend(self.deletions)
+        return mutations
+
+class WriteBehind(object):
+    """Writes mutation_maps with a few background threads, so callers don't wait for
+       batch_mutate. Pending writes of the same column are coalesced into the latest one
+       (see PendingRow), and up to batch_rows pending rows go out with one batch_mutate.
+       Once max_pending rows are waiting, submit() blocks until the writers catch up.
+
+       Failed writes are counted in stats, passed to on_error(error, mutation_map) and
+       raised by the futures of the saves they belonged to. Writes still pending when
+       the process exits are lost - flush() or close() first."""
+    def __init__(self, getclient, workers=2, max_pending=10000, batch_rows=100, on_error=None):
+        self.getclient = getclient
+        self.workers = workers
+        self.max_pending = max_pending
+        self.batch_rows = batch_rows
+        self.on_error = on_error
+        self.stats = dict(submitted=0, coalesced=0, batches=0, written=0, failed=0)
+        self._pending = OrderedDict() # (consistency_level, row_key, column_family) -> PendingRow
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._threads = []
+        self._closed = False
+
+    def submit(self, mutation_map, consistency_level):
+        """Queues mutation_map for writing and returns a WriteFuture for it."""
+        parts = [(row_key, column_family, mutations) for row_key, cfmap in mutation_map.iteritems()
+                                                     for column_family, mutations in cfmap.iteritems()]
+        future = WriteFuture(parts=len(parts))
+        if not parts:
+            future._part_done()
+            return future
+
+        with self._condition:
+            if self._closed:
+                raise TragedyException('This WriteBehind is closed.')
+            self._start()
+            for row_key, column_family, mutations in parts:
+                key = (consistency_level, row_key, column_family)
+                while key not in self._pending and len(self._pending) >= self.max_pending:
+                    self._condition.wait() # backpressure
+                pending = self._pending.get(key)
+                if pending is None:
+                    pending = self._pending[key] = PendingRow()
+                self.stats['coalesced'] += pending.add(mutations)
+                pending.futures.append(future)
+                self._condition.notify_all()
+            self.stats['submitted'] += 1
+        return future
+
+    def flush(self, timeout=None):
+        """Waits until everything submitted so far is written (or failed)."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._pending or self._in_flight:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise TragedyException('Write-behind not flushed after %s seconds.' % (timeout,))
+                self._condition.wait(remaining)
+
+    def close(self, timeout=None):
+        """Flushes, then stops the writer threads. Later submits raise."""
+        self.flush(timeout)
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _start(self):
+        if self._threads:
+            return
+        if not self.getclient().thread_safe:
+            raise TragedyException('Asynchronous saves need a thread-local connection, '
+                                   'see Keyspace.connect(thread_local=True).')
+        for i in xrange(self.workers):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _take_batch(self):
+        """Removes up to batch_rows pending rows with the same consistency level, or
+           returns None once we're closed and there's nothing left."""
+        with self._condition:
+            while not self._pending:
+                if self._closed:
+                    return None
+                self._condition.wait()
+            consistency_level = self._pending.keys()[0][0]
+            batch = []
+            for key in self._pending.keys():
+                if key[0] == consistency_level:
+                    batch.append((key, self._pending.pop(key)))
+                    if len(batch) >= self.batch_rows:
+                        break
+            self._in_flight += 1
+            self._condition.notify_all() # room for blocked submitters
+        return consistency_level, batch
+
+    def _worker(self):
+        while True:
+            taken = self._take_batch()
+            if taken is None:
+                return
+            consistency_level, batch = taken
+            mumap = {}
+            error = None
+            try:
+                for (cl, row_key, column_family), pending in batch:
+                    mumap.setdefault(row_key, {})[column_family] = pending.mutations()
+                self.getclient().batch_mutate(mutation_map=mumap, consistency_level=consistency_level)
+            except Exception, e: # whatever went wrong, it only fails this batch
+                error = e
+            finally:
+                self._finish_batch(batch, mumap, error)
+
+    def _finish_batch(self, batch, mumap, error):
+        try:
+            with self._condition:
+                self.stats['batches'] += 1
+                self.stats['failed' if error else 'written'] += len(batch)
+            if error is not None and self.on_error:
+                try:
+                    self.on_error(error, mumap)
+                except Exception:
+                    pass # a broken on_error mustn't take the writer down with it
+            for key, pending in batch:
+                for future in pending.futures:
+                    future._part_done(error)
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()